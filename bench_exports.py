@@ -0,0 +1,87 @@
+# Offline benchmark: builds the date x parameter export table with the old
+# pandas pivot and with the SQLite pivot used by exports.py.
+#
+#   python bench_exports.py [--rows 1000 100000 1000000] [--parameters 10]
+#
+# Each size gets its own throwaway database holding one chat with `rows`
+# entry values spread over `parameters` parameters (about 10% of the cells
+# left empty). Both paths start from the database and end with a list of
+# rows ready for a writer.
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import date, timedelta
+
+import pandas as pd
+import storage
+
+CHAT_ID = 1
+
+
+def seed(rows, parameters, rng):
+    names = [f"Param {i:02d}" for i in range(parameters)]
+    start = date(2000, 1, 1)
+    batch = []
+    day = 0
+    while len(batch) < rows:
+        for name in names:
+            if rng.random() < 0.9 and len(batch) < rows:
+                batch.append((CHAT_ID, (start + timedelta(days=day)).isoformat(), name, rng.randint(1, 10)))
+        day += 1
+    storage.add_entries(batch)
+    return names
+
+
+def pandas_pivot(names):
+    entries = storage.get_entries_from_db(CHAT_ID)
+    df = pd.DataFrame(entries, columns=["date", "parameter", "value"])
+    df = df.pivot(index="date", columns="parameter", values="value").reset_index()
+    df = df.fillna("")
+    return [df.columns.tolist()] + df.values.tolist()
+
+
+def sql_pivot(names):
+    return [["date"] + names] + storage.get_pivoted_entries(CHAT_ID, names)
+
+
+def timed(func, names, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(names)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(result) - 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pandas vs SQLite export pivot")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--parameters", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'days':>8} {'pandas':>10} {'sqlite':>10} {'speedup':>8}")
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            storage.DB_FILE = os.path.join(directory, "bench.db")
+            storage.init_db()
+            try:
+                names = seed(rows, args.parameters, random.Random(args.seed))
+                repeat = 5 if rows <= 100000 else 2
+                pandas_seconds, days = timed(pandas_pivot, names, repeat)
+                sql_seconds, sql_days = timed(sql_pivot, names, repeat)
+                if days != sql_days:
+                    print(f"row count mismatch: pandas {days}, sqlite {sql_days}")
+                print(f"{rows:>10} {days:>8} {pandas_seconds * 1000:>8.1f}ms {sql_seconds * 1000:>8.1f}ms "
+                      f"{pandas_seconds / sql_seconds:>7.1f}x")
+            finally:
+                storage.close_db()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
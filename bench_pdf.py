@@ -0,0 +1,94 @@
+# Offline benchmark: PDF render time against history length.
+#
+#   python bench_pdf.py [--days 500 1000 2000 4000 8000] [--parameters 6]
+#
+# Renders synthetic day rows with the original single-table layout and with
+# the page-sized tables built by exports.py (plus the monthly summary).
+# Per-1000-row times staying flat as the history grows means linear cost.
+
+import sys
+import time
+import random
+import argparse
+from io import BytesIO
+from datetime import date, timedelta
+
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
+from reportlab.lib.pagesizes import A4
+from reportlab.lib import colors
+from reportlab.lib.styles import getSampleStyleSheet
+
+import exports
+
+
+def make_rows(days, parameters, rng):
+    start = date(2000, 1, 1)
+    return [[(start + timedelta(days=i)).isoformat()] +
+            [rng.randint(1, 10) if rng.random() < 0.9 else None for _ in range(parameters)]
+            for i in range(days)]
+
+
+def single_table(header, rows):
+    # The export as it was: one Table holding every row
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    styles = getSampleStyleSheet()
+    data = [header] + [["" if value is None else value for value in row] for row in rows]
+    table = Table(data, repeatRows=1)
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0,0), (-1,0), colors.lightblue),
+        ('TEXTCOLOR',(0,0),(-1,0),colors.black),
+        ('ALIGN',(0,0),(-1,-1),'CENTER'),
+        ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0,0), (-1,0), 12),
+        ('FONTSIZE', (0,1), (-1,-1), 10),
+        ('BOTTOMPADDING', (0,0), (-1,0), 12),
+        ('BACKGROUND', (0,1), (-1,-1), colors.beige),
+        ('GRID', (0,0), (-1,-1), 1, colors.black),
+    ]))
+    doc.build([Paragraph("Daily Parameter Tracker", styles["Heading1"]), table])
+    return buffer.getvalue()
+
+
+def chunked(header, rows):
+    return exports._build_pdf("Daily Parameter Tracker", header, iter(rows))
+
+
+def summary(header, rows):
+    summary_header = ["month"] + header[1:] + ["days"]
+    return exports._build_pdf("Daily Parameter Tracker: monthly averages", summary_header,
+                              exports.monthly_summary(iter(rows), len(header) - 1))
+
+
+def timed(func, header, rows):
+    started = time.perf_counter()
+    func(header, rows)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PDF export render time")
+    parser.add_argument("--days", type=int, nargs="+", default=[500, 1000, 2000, 4000, 8000])
+    parser.add_argument("--parameters", type=int, default=6)
+    parser.add_argument("--max-single", type=int, default=4000,
+                        help="skip the single-table layout above this many days")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    header = ["date"] + [f"Param {i}" for i in range(args.parameters)]
+    print(f"{'days':>8} {'single':>16} {'chunked':>16} {'summary':>9}")
+    for days in args.days:
+        rows = make_rows(days, args.parameters, random.Random(args.seed))
+        if days <= args.max_single:
+            single = timed(single_table, header, rows)
+            single_text = f"{single:6.2f}s ({single / days * 1000:5.2f})"
+        else:
+            single_text = "skipped"
+        paged = timed(chunked, header, rows)
+        monthly = timed(summary, header, rows)
+        print(f"{days:>8} {single_text:>16} {paged:6.2f}s ({paged / days * 1000:5.2f}) {monthly:8.2f}s")
+    print("(seconds per 1000 rows in parentheses)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
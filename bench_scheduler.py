@@ -0,0 +1,215 @@
+# Offline benchmark: replays two days of reminders for synthetic users on a
+# simulated clock.
+#
+#   python bench_scheduler.py [--users N] [--start 2026-03-08T00:00] [--hours 48]
+#
+# A throwaway database under a temporary directory is filled with N users
+# spread over every available_timezones() zone, each with one or two random
+# reminder times. A ReminderScheduler then runs through the period tick by
+# tick: the simulated clock jumps straight to the next due reminder and only
+# advances by the real time spent processing, so lateness measures the
+# scheduler and its DB work, not waiting. Sends go through send_reminder()
+# to a stub bot that records them instead of calling Telegram.
+#
+# The default start dates cover the US (2026-03-08) and EU (2026-03-29)
+# spring-forward days; pass --start several times for other days. Periods
+# run 48 hours by default so that the day after a transition is replayed
+# too: a reminder mis-keyed around the transition only goes missing when
+# the next day's one collides with it.
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, available_timezones
+
+import storage
+import reminders
+from bot_updated import send_reminder
+
+DEFAULT_STARTS = ("2026-03-08T00:00", "2026-03-29T00:00")
+# Always included: slots that fall into a spring-forward gap crossing local
+# midnight (Greenland, 2026-03-28 23:00 -> 00:00), so they fire on the next
+# local date while still being the previous day's reminder
+GAP_USERS = (
+    ("America/Nuuk", ["23:35"]),
+    ("America/Godthab", ["23:00", "23:59"]),
+    ("America/Scoresbysund", ["23:30"]),
+)
+
+
+class SimulatedClock:
+    # now() is the simulated instant plus the real time elapsed since the
+    # last advance(); sleeping never blocks
+    def __init__(self, start):
+        self.advance(start)
+
+    def advance(self, to):
+        self.current = to
+        self._started = time.perf_counter()
+
+    def now(self):
+        return self.current + timedelta(seconds=time.perf_counter() - self._started)
+
+    async def sleep(self, seconds):
+        self.advance(self.now() + timedelta(seconds=seconds))
+
+    async def wait(self, event, timeout):
+        if not event.is_set():
+            await self.sleep(timeout)
+
+
+class StubBot:
+    def __init__(self, clock):
+        self.clock = clock
+        self.sent = {}                  # chat_id -> [UTC instant, ...]
+
+    async def send_message(self, chat_id, text):
+        self.sent.setdefault(chat_id, []).append(self.clock.now())
+
+
+def random_slot(rng):
+    return f"{rng.randrange(24):02d}:{rng.randrange(60):02d}"
+
+
+def make_users(count, seed):
+    rng = random.Random(seed)
+    zones = sorted(available_timezones())
+    users = []
+    for user_id in range(1, count + 1):
+        slots = sorted({random_slot(rng) for _ in range(rng.choice((1, 1, 2)))})
+        users.append((user_id, zones[user_id % len(zones)], slots))
+    for tz_name, slots in GAP_USERS:
+        users.append((len(users) + 1, tz_name, slots))
+    return users
+
+
+def seed_db(users):
+    started = time.perf_counter()
+    settings = [(user_id, tz) for user_id, tz, _ in users]
+    slots = [(user_id, slot) for user_id, _, user_slots in users for slot in user_slots]
+    for shard, rows in storage._group_by_shard(settings).items():
+        with storage.get_pool(storage.shard_path(shard)).connection() as conn:
+            with conn:
+                conn.executemany("INSERT INTO user_settings (user_id, timezone) VALUES (?, ?)", rows)
+    for shard, rows in storage._group_by_shard(slots).items():
+        with storage.get_pool(storage.shard_path(shard)).connection() as conn:
+            with conn:
+                conn.executemany("INSERT INTO user_reminders (user_id, reminder_time) VALUES (?, ?)", rows)
+    print(f"Seeded {len(users)} users / {len(slots)} reminders in {time.perf_counter() - started:.1f}s")
+
+
+def expected_sends(users, start, end):
+    # Independent slow path: every (user, local day) occurrence in (start, end]
+    # computed straight from ZoneInfo
+    fire_times = {}
+    expected = {}
+    for user_id, tz_name, slots in users:
+        times = []
+        for slot in slots:
+            key = (tz_name, slot)
+            if key not in fire_times:
+                tz = ZoneInfo(tz_name)
+                occurrences = []
+                at, _ = reminders.next_fire_time(slot, tz, start)
+                while at <= end:
+                    occurrences.append(at)
+                    at, _ = reminders.next_fire_time(slot, tz, at)
+                fire_times[key] = occurrences
+            times.extend(fire_times[key])
+        expected[user_id] = sorted(times)
+    return expected
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def simulate(users, start, hours):
+    end = start + timedelta(hours=hours)
+    clock = SimulatedClock(start)
+    bot = StubBot(clock)
+    scheduler = reminders.ReminderScheduler(lambda user_id: send_reminder(user_id, bot),
+                                            owner="bench", clock=clock)
+    scheduler.partitions = set(range(storage.REMINDER_PARTITIONS))
+
+    load_started = time.perf_counter()
+    for user_id, tz, slots in await storage.get_all_users_with_reminders_async():
+        scheduler.set_user(user_id, tz, slots, start)
+    print(f"Loaded {len(scheduler._user_groups)} users into {len(scheduler._groups)} groups "
+          f"in {time.perf_counter() - load_started:.1f}s")
+
+    # Mirrors ReminderScheduler.run(): wake at the next heap entry, or after
+    # MAX_SLEEP when nothing is due sooner
+    tick_cpu = []
+    quiet = open(os.devnull, "w")
+    while True:
+        wake = clock.now() + timedelta(seconds=reminders.MAX_SLEEP)
+        if scheduler._heap:
+            wake = max(clock.now(), min(wake, scheduler._heap[0][0]))
+        if wake > end:
+            break
+        clock.advance(wake)
+        cpu = time.process_time()
+        with contextlib.redirect_stdout(quiet):     # per-send log lines
+            await scheduler.run_due()
+        tick_cpu.append(time.process_time() - cpu)
+    quiet.close()
+
+    expected = expected_sends(users, start, end)
+    lateness = []
+    missed = duplicates = early = 0
+    for user_id, want in expected.items():
+        got = sorted(bot.sent.get(user_id, ()))
+        missed += max(0, len(want) - len(got))
+        duplicates += max(0, len(got) - len(want))
+        for due, sent in zip(want, got):
+            delta = (sent - due).total_seconds()
+            if delta < 0:
+                early += 1
+            lateness.append(delta)
+    lateness.sort()
+    tick_cpu.sort()
+
+    print(f"Simulated {start:%Y-%m-%d %H:%M} +{hours}h UTC")
+    print(f"  ticks: {len(tick_cpu)}, CPU total {sum(tick_cpu):.2f}s, "
+          f"p50 {percentile(tick_cpu, 0.5) * 1000:.2f}ms, p99 {percentile(tick_cpu, 0.99) * 1000:.2f}ms, "
+          f"max {percentile(tick_cpu, 1.0) * 1000:.2f}ms")
+    print(f"  sends: {sum(len(v) for v in bot.sent.values())} of {sum(len(v) for v in expected.values())} expected, "
+          f"missed {missed}, duplicates {duplicates}, early {early}")
+    print(f"  lateness: p50 {percentile(lateness, 0.5) * 1000:.1f}ms, p90 {percentile(lateness, 0.9) * 1000:.1f}ms, "
+          f"p99 {percentile(lateness, 0.99) * 1000:.1f}ms, max {percentile(lateness, 1.0) * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated-clock reminder scheduler benchmark")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--start", action="append",
+                        help="UTC start of a simulated period (default: US and EU DST days)")
+    parser.add_argument("--hours", type=float, default=48)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    starts = [datetime.fromisoformat(s).replace(tzinfo=timezone.utc) for s in args.start or DEFAULT_STARTS]
+    users = make_users(args.users, args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        storage.DB_FILE = os.path.join(directory, "bench.db")
+        storage.init_db()
+        try:
+            seed_db(users)
+            for start in starts:
+                asyncio.run(simulate(users, start, args.hours))
+        finally:
+            storage.close_db()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
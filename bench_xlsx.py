@@ -0,0 +1,124 @@
+# Offline benchmark: peak memory and time of the XLSX export paths.
+#
+#   python bench_xlsx.py [--rows 10000 100000 1000000] [--parameters 20]
+#
+# For each size a throwaway database is seeded with one chat, then every
+# path runs in a fresh interpreter so peak RSS (VmHWM, Linux only) is not
+# polluted by the previous one:
+#   pandas     the original pd.ExcelWriter(engine='openpyxl') export
+#   workbook   openpyxl's regular in-memory workbook fed from the SQL pivot
+#   streaming  exports.render_xlsx (write-only, straight from the cursor)
+# Memory is reported as the peak above the RSS right before the export.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from io import BytesIO
+from datetime import date, timedelta
+
+import storage
+
+CHAT_ID = 1
+MODES = ("pandas", "workbook", "streaming")
+
+
+def _memory_kb(field):
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def seed(rows, parameters, rng):
+    names = [f"Param {i:02d}" for i in range(parameters)]
+    start = date(1990, 1, 1)
+    batch = []
+    day = 0
+    while len(batch) < rows:
+        for name in names:
+            if rng.random() < 0.9 and len(batch) < rows:
+                batch.append((CHAT_ID, (start + timedelta(days=day)).isoformat(), name, rng.randint(1, 10)))
+        day += 1
+    storage.add_entries(batch)
+    return names
+
+
+def run_mode(mode, names):
+    if mode == "pandas":
+        import pandas as pd
+        entries = storage.get_entries_from_db(CHAT_ID)
+        df = pd.DataFrame(entries, columns=["date", "parameter", "value"])
+        df = df.pivot(index="date", columns="parameter", values="value").reset_index()
+        df = df.fillna("")
+        buffer = BytesIO()
+        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+            df.to_excel(writer, index=False, sheet_name='Daily Tracker')
+        return len(buffer.getvalue())
+    if mode == "workbook":
+        from openpyxl import Workbook
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.title = 'Daily Tracker'
+        sheet.append(["date"] + names)
+        for row in storage.iter_pivoted_entries(CHAT_ID, names):
+            sheet.append(row)
+        buffer = BytesIO()
+        workbook.save(buffer)
+        return len(buffer.getvalue())
+    import exports
+    return len(exports.render_xlsx(CHAT_ID, names))
+
+
+def child(mode, db_file, names):
+    # Imports and the DB connection are paid for before the baseline
+    storage.DB_FILE = db_file
+    import pandas, openpyxl, exports    # noqa: F401
+    storage.get_entries_version(CHAT_ID)
+    baseline = _memory_kb("VmRSS")
+    started = time.perf_counter()
+    size = run_mode(mode, names)
+    print(json.dumps({
+        "seconds": time.perf_counter() - started,
+        "peak_mb": (_memory_kb("VmHWM") - baseline) / 1024,
+        "bytes": size,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="XLSX export memory benchmark")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--parameters", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "DB"), help=argparse.SUPPRESS)
+    parser.add_argument("--names", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.child[1], json.loads(args.names))
+        return
+
+    print(f"{'rows':>10} {'mode':>10} {'time':>9} {'peak':>10} {'file':>10}")
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            db_file = os.path.join(directory, "bench.db")
+            storage.DB_FILE = db_file
+            storage.init_db()
+            names = seed(rows, args.parameters, random.Random(args.seed))
+            storage.close_db()
+            for mode in MODES:
+                output = subprocess.run(
+                    [sys.executable, __file__, "--child", mode, db_file, "--names", json.dumps(names)],
+                    check=True, capture_output=True, text=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f"{rows:>10} {mode:>10} {result['seconds']:>8.2f}s {result['peak_mb']:>8.1f}MB "
+                      f"{result['bytes'] / 1024:>8.0f}KB")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
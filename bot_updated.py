@@ -1,21 +1,27 @@
 #There was a bug when u press "Settings" sometimes bot few times reacted as "Please enter a number between 1 and 10:" before showing settings. Fixed ver here.
 
-from telegram import Update, ReplyKeyboardMarkup
+from telegram import Bot, Update, ReplyKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
-from datetime import datetime, time
+from telegram.ext import BaseUpdateProcessor
+from datetime import datetime, time, timedelta
 from zoneinfo import ZoneInfo, available_timezones
 import asyncio
 import nest_asyncio
-import sqlite3
-import json
-import pandas as pd
 from io import BytesIO
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet
 import difflib
 import random  
+import sys
+from storage import (
+    init_db, close_db, get_entries_version_async, has_entries_async,
+    get_last_export_async, set_last_export_async,
+    get_user_parameters_async, add_user_parameters_async, remove_user_parameter_async,
+    get_user_timezone_async, set_user_timezone_async,
+    set_user_reminders_async, WriteBehindBuffer,
+)
+from reminders import ReminderScheduler
+from dispatch import ReminderDispatcher
+from exports import write_csv, ExportJobs, ExportQueueFull, ExportCache, PARQUET_AVAILABLE
 
 nest_asyncio.apply()
 
@@ -26,8 +32,7 @@ ADD_PARAM, DELETE_PARAM_SELECT = range(2)
 ESTIMATE_START = range(1)
 EXPORT_CHOOSE = range(1)
 SET_TIMEZONE, SET_REMINDERS = range(2, 4)
-
-DB_FILE = "mood_tracker.db"
+EXPORT_RANGE, EXPORT_CUSTOM_RANGE = range(4, 6)
 
 # =======================
 # Keyboards
@@ -49,189 +54,119 @@ PARAMETER_MENU = ReplyKeyboardMarkup([
     ["Custom Parameter", "Finish", "Cancel"]
 ], resize_keyboard=True, one_time_keyboard=True)
 
+# format -> (filename, caption)
+EXPORT_FORMATS = {
+    "csv": ("daily_tracker.csv", "📊 CSV format"),
+    "xlsx": ("daily_tracker.xlsx", "📊 Excel format"),
+    "pdf": ("daily_tracker.pdf", "📄 PDF format"),
+    "pdf summary": ("daily_tracker_summary.pdf", "📄 PDF monthly summary"),
+    "csv (gzip)": ("daily_tracker.csv.gz", "🗜 CSV format, gzip"),
+    "csv (zip)": ("daily_tracker.zip", "🗜 CSV format, zip"),
+}
+if PARQUET_AVAILABLE:
+    EXPORT_FORMATS["parquet"] = ("daily_tracker.parquet", "📦 Parquet format")
+
+# CSV formats -> compression, written on a thread instead of the render pool
+CSV_FORMATS = {
+    "csv": None,
+    "csv (gzip)": "gzip",
+    "csv (zip)": "zip",
+}
+
 EXPORT_MENU = ReplyKeyboardMarkup([
-    ["CSV", "XLSX", "PDF"], ["Cancel"]
+    ["CSV", "XLSX", "PDF"],
+    ["PDF summary", "CSV (gzip)", "CSV (zip)"],
+    ["Parquet", "Cancel"] if PARQUET_AVAILABLE else ["Cancel"]
+], resize_keyboard=True, one_time_keyboard=True)
+
+EXPORT_RANGE_MENU = ReplyKeyboardMarkup([
+    ["Last 7 days", "Last 30 days", "Last 90 days"],
+    ["Since last export", "All time", "Custom range"],
+    ["Cancel"]
 ], resize_keyboard=True, one_time_keyboard=True)
 
+# range button -> number of days back, including today
+EXPORT_RANGE_DAYS = {
+    "Last 7 days": 7,
+    "Last 30 days": 30,
+    "Last 90 days": 90,
+}
+
 TIMEZONE_MENU = ReplyKeyboardMarkup([
     ["New York", "London", "Berlin", "Tokyo"],
     ["Moscow", "Sydney", "Los Angeles", "Other"],
     ["Cancel"]
 ], resize_keyboard=True)
 
+entry_buffer = WriteBehindBuffer()
+export_jobs = ExportJobs()
+export_cache = ExportCache()
+
 # =======================
-# Database functions
+# Update processing
 # =======================
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS entries (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        chat_id INTEGER,
-        date TEXT,
-        parameter TEXT,
-        value INTEGER
-    )
-    """)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS user_settings (
-        user_id INTEGER PRIMARY KEY,
-        timezone TEXT DEFAULT 'UTC',
-        reminders TEXT,
-        parameters TEXT
-    )
-    """)
-    conn.commit()
-    conn.close()
-
-def add_entry_to_db(chat_id, date, parameter, value):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("INSERT INTO entries (chat_id, date, parameter, value) VALUES (?, ?, ?, ?)",
-              (chat_id, date, parameter, value))
-    conn.commit()
-    conn.close()
-
-def get_entries_from_db(chat_id, start_date=None, end_date=None):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    query = "SELECT date, parameter, value FROM entries WHERE chat_id=?"
-    params = [chat_id]
-    if start_date:
-        query += " AND date >= ?"
-        params.append(start_date)
-    if end_date:
-        query += " AND date <= ?"
-        params.append(end_date)
-    query += " ORDER BY date DESC"
-    c.execute(query, params)
-    rows = c.fetchall()
-    conn.close()
-    return rows
-
-def get_user_parameters(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT parameters FROM user_settings WHERE user_id=?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    if result and result[0]:
-        try:
-            return json.loads(result[0])
-        except json.JSONDecodeError:
-            return []
-    return []
-
-def set_user_parameters(user_id, parameters):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    params_json = json.dumps(parameters)
-    c.execute("""INSERT OR REPLACE INTO user_settings 
-                 (user_id, parameters, timezone, reminders) 
-                 VALUES (?, ?, 
-                         COALESCE((SELECT timezone FROM user_settings WHERE user_id=?), 'UTC'), 
-                         COALESCE((SELECT reminders FROM user_settings WHERE user_id=?), '[]'))""",
-              (user_id, params_json, user_id, user_id))
-    conn.commit()
-    conn.close()
-
-def get_user_timezone(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT timezone FROM user_settings WHERE user_id=?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result[0] if result else "UTC"
-
-def set_user_timezone(user_id, timezone):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("""INSERT OR REPLACE INTO user_settings 
-                 (user_id, timezone, parameters, reminders) 
-                 VALUES (?, ?, 
-                         COALESCE((SELECT parameters FROM user_settings WHERE user_id=?), '[]'), 
-                         COALESCE((SELECT reminders FROM user_settings WHERE user_id=?), '[]'))""",
-              (user_id, timezone, user_id, user_id))
-    conn.commit()
-    conn.close()
-
-def get_user_reminders(user_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT reminders FROM user_settings WHERE user_id=?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    if result and result[0]:
+# Most updates that may be processed at once
+MAX_CONCURRENT_UPDATES = 256
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    # Updates from different chats are processed concurrently, so that their
+    # ratings can share a group commit in entry_buffer. Updates of the same
+    # chat still run one at a time and in order, as ConversationHandler
+    # needs for its state and user_data.
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}                # chat_id -> [asyncio.Lock, updates holding or waiting]
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await coroutine
+            return
+        entry = self._chats.get(chat.id)
+        if entry is None:
+            entry = self._chats[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
         try:
-            return json.loads(result[0])
-        except json.JSONDecodeError:
-            return []
-    return []
-
-def set_user_reminders(user_id, reminders):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    reminders_json = json.dumps(reminders)
-    c.execute("""INSERT OR REPLACE INTO user_settings 
-                 (user_id, reminders, timezone, parameters) 
-                 VALUES (?, ?, 
-                         COALESCE((SELECT timezone FROM user_settings WHERE user_id=?), 'UTC'), 
-                         COALESCE((SELECT parameters FROM user_settings WHERE user_id=?), '[]'))""",
-              (user_id, reminders_json, user_id, user_id))
-    conn.commit()
-    conn.close()
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 # =======================
 # Reminder system 
 # =======================
-last_sent = {}
-
-async def send_reminder(user_id: int, app: Application):
+async def send_reminder(user_id: int, bot: Bot):
+    # Errors are handled (retried or logged) by the dispatcher
+    await bot.send_message(user_id, "⏰ Time to rate your daily parameters!")
+
+async def schedule_reminders(bot: Bot):
+    # The scheduler decides who is due, the dispatcher sends as fast as
+    # Telegram's flood limits allow. Any number of these can run side by
+    # side (see run_reminder_worker); they split the users between them.
+    dispatcher = ReminderDispatcher(lambda user_id: send_reminder(user_id, bot))
+    scheduler = ReminderScheduler(dispatcher.submit)
+    sending = asyncio.create_task(dispatcher.run())
     try:
-        await app.bot.send_message(user_id, "⏰ Time to rate your daily parameters!")
-    except Exception as e:
-        print(f"Failed reminder to {user_id}: {e}")
-
-def get_all_users_with_reminders():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT user_id, timezone, reminders FROM user_settings WHERE reminders IS NOT NULL AND reminders != '[]'")
-    results = c.fetchall()
-    conn.close()
-    return results
-
-async def schedule_reminders(app: Application):
-    global last_sent
-    while True:
-        users = get_all_users_with_reminders()
-        current_utc = datetime.utcnow()
-        
-        for user_id, tz_str, reminders_json in users:
-            try:
-                tz = ZoneInfo(tz_str) if tz_str else ZoneInfo("UTC")
-                user_time = current_utc.replace(tzinfo=ZoneInfo("UTC")).astimezone(tz)
-                
-                if user_id not in last_sent:
-                    last_sent[user_id] = {}
-                
-                reminders = json.loads(reminders_json)
-                for reminder_time in reminders:
-                    h, m = map(int, reminder_time.split(':'))
-                    target_time = user_time.replace(hour=h, minute=m, second=0, microsecond=0)
-                    
-                    time_diff = (user_time - target_time).total_seconds()
-                    if abs(time_diff) < 60:  # Within 1 minute
-                        today_str = user_time.date().isoformat()
-                        if last_sent[user_id].get(reminder_time) != today_str:
-                            await send_reminder(user_id, app)
-                            last_sent[user_id][reminder_time] = today_str
-                            print(f"Sent reminder to {user_id} at {reminder_time}")
-                            
-            except Exception as e:
-                print(f"Error processing reminders for user {user_id}: {e}")
-        
-        await asyncio.sleep(30)  # Check every 30 seconds
+        await scheduler.run()
+    finally:
+        # Stopped only after the scheduler, which drains the queue on its
+        # way out and hands back what was left
+        sending.cancel()
+        await asyncio.gather(sending, return_exceptions=True)
+
+async def run_reminder_worker(token: str):
+    # Standalone reminder process: no polling, only the scheduler
+    async with Bot(token) as bot:
+        await schedule_reminders(bot)
 
 
 # =======================
@@ -255,7 +190,7 @@ async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =======================
 async def estimate_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    parameters = get_user_parameters(user_id)
+    parameters = await get_user_parameters_async(user_id)
     
     if not parameters:
         await update.message.reply_text(
@@ -314,9 +249,13 @@ async def save_ratings(update, context):
     user_id = update.message.from_user.id
     ratings = context.user_data['ratings']
     today = datetime.now().strftime("%Y-%m-%d")
+    # The user's own date, so today's remaining reminders are skipped
+    user_tz = await get_user_timezone_async(user_id)
+    local_today = datetime.now(ZoneInfo(user_tz or "UTC")).date().isoformat()
     
-    for param, value in ratings.items():
-        add_entry_to_db(user_id, today, param, value)
+    # Returns only after the group commit containing these rows has landed
+    await entry_buffer.submit([(user_id, today, param, value) for param, value in ratings.items()],
+                              rated=(user_id, local_today))
     
     summary = ", ".join([f"{k}={v}" for k, v in ratings.items()])
     
@@ -353,9 +292,7 @@ async def parameter_received(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if text == "Finish":
         new_params = context.user_data.get('new_params', [])
         if new_params:
-            current_params = get_user_parameters(user_id)
-            all_params = sorted(list(set(current_params + new_params)))
-            set_user_parameters(user_id, all_params)
+            await add_user_parameters_async(user_id, new_params)
             await update.message.reply_text(
                 f"✅ Added parameters: {', '.join(new_params)}", 
                 reply_markup=SETTINGS_MENU
@@ -431,7 +368,7 @@ async def parameter_received(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # =======================
 async def delete_parameter_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    parameters = get_user_parameters(user_id)
+    parameters = await get_user_parameters_async(user_id)
     
     if not parameters:
         await update.message.reply_text("No parameters to delete.", reply_markup=SETTINGS_MENU)
@@ -453,10 +390,7 @@ async def delete_parameter_selected(update: Update, context: ContextTypes.DEFAUL
         await cancel(update, context)
         return ConversationHandler.END
     
-    parameters = get_user_parameters(user_id)
-    if text in parameters:
-        parameters.remove(text)
-        set_user_parameters(user_id, parameters)
+    if await remove_user_parameter_async(user_id, text):
         await update.message.reply_text(f"✅ Deleted parameter '{text}'.", reply_markup=SETTINGS_MENU)
     else:
         await update.message.reply_text("Parameter not found.", reply_markup=SETTINGS_MENU)
@@ -493,7 +427,7 @@ async def timezone_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if user_input in timezone_map:
         timezone_name = timezone_map[user_input]
-        set_user_timezone(user_id, timezone_name)
+        await set_user_timezone_async(user_id, timezone_name)
         await update.message.reply_text(
             f"✅ Timezone set to {user_input} ({timezone_name})", 
             reply_markup=SETTINGS_MENU
@@ -507,7 +441,7 @@ async def timezone_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return SET_TIMEZONE
     else:
         if user_input in available_timezones():
-            set_user_timezone(user_id, user_input)
+            await set_user_timezone_async(user_id, user_input)
             await update.message.reply_text(f"✅ Timezone set to {user_input}", reply_markup=SETTINGS_MENU)
             return ConversationHandler.END
         else:
@@ -546,8 +480,8 @@ async def reminders_received(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if len(user_input) == 5 and user_input[2] == ':':
             hours, minutes = map(int, user_input.split(':'))
             if 0 <= hours <= 23 and 0 <= minutes <= 59:
-                set_user_reminders(user_id, [user_input])
-                user_tz = get_user_timezone(user_id)
+                await set_user_reminders_async(user_id, [user_input])
+                user_tz = await get_user_timezone_async(user_id)
                 await update.message.reply_text(
                     f"✅ Reminder set for {user_input} daily ({user_tz})!", 
                     reply_markup=SETTINGS_MENU
@@ -563,11 +497,11 @@ async def reminders_received(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # =======================
 async def export_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    entries = get_entries_from_db(user_id)
+    has_entries = await has_entries_async(user_id)
     
-    if not entries:
+    if not has_entries:
         # Show what would be exported (empty with current parameters)
-        params = get_user_parameters(user_id)
+        params = await get_user_parameters_async(user_id)
         if params:
             await update.message.reply_text(
                 f"📤 No data yet, but export will include columns:\n"
@@ -593,83 +527,124 @@ async def export_format_chosen(update: Update, context: ContextTypes.DEFAULT_TYP
         await cancel(update, context)
         return ConversationHandler.END
     
-    if fmt not in ["csv", "xlsx", "pdf"]:
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text("❌ Invalid option.", reply_markup=MAIN_MENU)
+        return ConversationHandler.END
+    
+    context.user_data['export_format'] = fmt
+    await update.message.reply_text("📅 Which days should be exported?", reply_markup=EXPORT_RANGE_MENU)
+    return EXPORT_RANGE
+
+async def export_range_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    
+    if text in ["Cancel", "Settings", "Back to Main"]:
+        await cancel(update, context)
+        return ConversationHandler.END
+    
+    # Entry dates are the server's local dates (see save_ratings)
+    today = datetime.now().date()
+    if text in EXPORT_RANGE_DAYS:
+        start_date = (today - timedelta(days=EXPORT_RANGE_DAYS[text] - 1)).isoformat()
+    elif text == "Since last export":
+        # Includes the day of the last export, it may have been rated after it
+        start_date = await get_last_export_async(update.message.from_user.id)
+    elif text == "All time":
+        start_date = None
+    elif text == "Custom range":
+        await update.message.reply_text(
+            "📅 Enter the range as YYYY-MM-DD YYYY-MM-DD (e.g., 2025-01-01 2025-03-31):",
+            reply_markup=ReplyKeyboardMarkup([["Cancel"]], resize_keyboard=True)
+        )
+        return EXPORT_CUSTOM_RANGE
+    else:
+        await update.message.reply_text("❌ Invalid option.", reply_markup=MAIN_MENU)
+        return ConversationHandler.END
+    
+    return await send_export(update, context, start_date, None)
+
+async def export_custom_range(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    
+    if text in ["Cancel", "Settings", "Back to Main"]:
+        await cancel(update, context)
+        return ConversationHandler.END
+    
+    try:
+        start_date, end_date = (datetime.strptime(part, "%Y-%m-%d").date() for part in text.split())
+    except ValueError:
+        await update.message.reply_text("⚠️ Invalid format. Please use YYYY-MM-DD YYYY-MM-DD:")
+        return EXPORT_CUSTOM_RANGE
+    if start_date > end_date:
+        start_date, end_date = end_date, start_date
+    
+    return await send_export(update, context, start_date.isoformat(), end_date.isoformat())
+
+async def send_export(update: Update, context: ContextTypes.DEFAULT_TYPE, start_date, end_date):
+    fmt = context.user_data.pop('export_format', None)
+    if fmt not in EXPORT_FORMATS:
         await update.message.reply_text("❌ Invalid option.", reply_markup=MAIN_MENU)
         return ConversationHandler.END
     
     chat_id = update.message.chat_id
     user_id = update.message.from_user.id
-    entries = get_entries_from_db(chat_id)
     
-    # Always create DataFrame with user parameters as columns
-    user_params = get_user_parameters(user_id)
+    # Always export the user's parameters as columns
+    user_params = await get_user_parameters_async(user_id)
     if not user_params:
         await update.message.reply_text("❌ No parameters set.", reply_markup=MAIN_MENU)
         return ConversationHandler.END
     
-    if not entries:
-        # Create empty DataFrame with correct columns
-        columns = ["date"] + user_params
-        df = pd.DataFrame(columns=columns)
-    else:
-        # Convert to pivot table format
-        df = pd.DataFrame(entries, columns=["date", "parameter", "value"])
-        df = df.pivot_table(index="date", columns="parameter", values="value", aggfunc="first").reset_index()
-        df = df.fillna("")
-    
+    filename, caption = EXPORT_FORMATS[fmt]
+    if start_date or end_date:
+        caption += f" ({start_date or 'start'} – {end_date or 'today'})"
     try:
-        buffer = BytesIO()
-        
-        if fmt == "xlsx":
-            with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Daily Tracker')
-            buffer.seek(0)
-            filename = "daily_tracker.xlsx"
-            caption = "📊 Excel format"
+        # Same data, columns and range as an export already sent: resend that file
+        cache_key = (user_id, fmt, await get_entries_version_async(chat_id), tuple(user_params),
+                     start_date, end_date)
+        file_id = export_cache.get(cache_key)
+        sent = False
+        if file_id is not None:
+            try:
+                await update.message.reply_document(
+                    document=file_id,
+                    caption=caption,
+                    reply_markup=MAIN_MENU
+                )
+                sent = True
+            except BadRequest:
+                # The file id is no longer accepted; render it again
+                export_cache.discard(cache_key)
         
-        elif fmt == "pdf":
-            doc = SimpleDocTemplate(buffer, pagesize=A4)
-            styles = getSampleStyleSheet()
-            elements = [Paragraph("Daily Parameter Tracker", styles["Heading1"])]
-            
-            data = [df.columns.tolist()]
-            if not df.empty:
-                data += df.values.tolist()
+        if not sent:
+            # Pivoted by SQLite into one row per day with a column per
+            # parameter; the date bounds are a range scan on the entry key
+            if fmt in CSV_FORMATS:
+                # Streamed from the cursor into a spooled file
+                buffer = await asyncio.to_thread(write_csv, chat_id, user_params, start_date, end_date,
+                                                 CSV_FORMATS[fmt])
             else:
-                # Add empty row to show structure
-                data.append([""] * len(df.columns))
+                # Rendered by a worker process reading the cursor itself (a
+                # write-only workbook, page-sized PDF tables or Parquet
+                # record batches); the event loop only waits
+                data = await export_jobs.render(user_id, fmt, chat_id, user_params, start_date, end_date,
+                                                variant=(start_date, end_date))
+                buffer = BytesIO(data)
             
-            table = Table(data, repeatRows=1)
-            table.setStyle(TableStyle([
-                ('BACKGROUND', (0,0), (-1,0), colors.lightblue),
-                ('TEXTCOLOR',(0,0),(-1,0),colors.black),
-                ('ALIGN',(0,0),(-1,-1),'CENTER'),
-                ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0,0), (-1,0), 12),
-                ('FONTSIZE', (0,1), (-1,-1), 10),
-                ('BOTTOMPADDING', (0,0), (-1,0), 12),
-                ('BACKGROUND', (0,1), (-1,-1), colors.beige),
-                ('GRID', (0,0), (-1,-1), 1, colors.black),
-            ]))
-            elements.append(table)
-            doc.build(elements)
-            buffer.seek(0)
-            filename = "daily_tracker.pdf"
-            caption = "📄 PDF format"
-        
-        else:  # CSV
-            df.to_csv(buffer, index=False, encoding='utf-8')
-            buffer.seek(0)
-            filename = "daily_tracker.csv"
-            caption = "📊 CSV format"
+            with buffer:
+                message = await update.message.reply_document(
+                    document=buffer,
+                    filename=filename,
+                    caption=caption,
+                    reply_markup=MAIN_MENU
+                )
+            export_cache.put(cache_key, message.document.file_id)
         
-        await update.message.reply_document(
-            document=buffer,
-            filename=filename,
-            caption=caption,
-            reply_markup=MAIN_MENU
-        )
+        await set_last_export_async(user_id, datetime.now().date())
     
+    except ExportQueueFull:
+        await update.message.reply_text("⏳ Too many exports right now, please try again in a minute.",
+                                        reply_markup=MAIN_MENU)
     except Exception as e:
         await update.message.reply_text(f"❌ Export error: {str(e)}", reply_markup=MAIN_MENU)
     
@@ -767,13 +742,48 @@ if __name__ == "__main__":
     # REPLACE WITH YOUR ACTUAL BOT TOKEN
     TOKEN = "MYAU"
     
-    app = Application.builder().token(TOKEN).build()
+    # python bot_updated.py --reminder-worker   only sends reminders
+    # python bot_updated.py --no-reminders      only answers chats
+    if "--reminder-worker" in sys.argv:
+        print("⏰ Reminder worker is starting...")
+        try:
+            asyncio.run(run_reminder_worker(TOKEN))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            close_db()
+        sys.exit(0)
+    
+    reminder_tasks = []
+
+    async def on_stop(app: Application):
+        # Reminders still queued get a last chance to go out while the bot
+        # can still send, the rest are handed back to the ledger
+        for task in reminder_tasks:
+            task.cancel()
+        await asyncio.gather(*reminder_tasks, return_exceptions=True)
+
+    async def on_shutdown(app: Application):
+        # Flush buffered ratings before the process exits
+        await entry_buffer.close()
+        export_jobs.shutdown()
+    
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor())
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Conversation handlers with navigation buttons in keyboards
     export_conv = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex("^(Export results)$"), export_start)],
         states={
-            EXPORT_CHOOSE: [MessageHandler(filters.TEXT & ~filters.COMMAND, export_format_chosen)]
+            EXPORT_CHOOSE: [MessageHandler(filters.TEXT & ~filters.COMMAND, export_format_chosen)],
+            EXPORT_RANGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, export_range_chosen)],
+            EXPORT_CUSTOM_RANGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, export_custom_range)]
         },
         fallbacks=[
             CommandHandler("cancel", cancel),
@@ -865,7 +875,11 @@ if __name__ == "__main__":
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_handler))
     
     # Start reminders in background 
-    asyncio.get_event_loop().create_task(schedule_reminders(app))
+    if "--no-reminders" not in sys.argv:
+        reminder_tasks.append(asyncio.get_event_loop().create_task(schedule_reminders(app.bot)))
     
     print("🤖 Bot is starting...")
-    app.run_polling()
+    try:
+        app.run_polling()
+    finally:
+        close_db()
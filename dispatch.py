@@ -0,0 +1,151 @@
+import asyncio
+import time
+from datetime import timedelta
+from telegram.error import RetryAfter, NetworkError, BadRequest
+
+# Bot API flood limits: about 30 messages per second overall and about one
+# message per second to the same chat.
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+PER_CHAT_INTERVAL = 1.0
+CONCURRENCY = 20
+MAX_ATTEMPTS = 4
+
+
+def _settle(outcome, result):
+    if not outcome.done():
+        outcome.set_result(result)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ReminderDispatcher:
+    # Sends queued messages with bounded concurrency under a global token
+    # bucket and a per-chat spacing. A RetryAfter from Telegram pauses every
+    # worker for the requested time; transient network errors are retried
+    # with exponential backoff, permanent errors (blocked bot, bad chat) are
+    # dropped.
+    #
+    # submit() returns a future of the outcome: True once sent, False when
+    # dropped for a permanent error, and the last error once the retries of
+    # a transient one are used up. A message whose future is cancelled
+    # before its turn is not sent; stopping run() cancels every unsettled one.
+    def __init__(self, send, concurrency=CONCURRENCY, rate=GLOBAL_RATE, burst=GLOBAL_BURST,
+                 per_chat_interval=PER_CHAT_INTERVAL, max_attempts=MAX_ATTEMPTS):
+        self.send = send                # async send(chat_id)
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._bucket = TokenBucket(rate, burst)
+        self._queue = asyncio.Queue()
+        self._unsettled = set()
+        self._retry_handles = set()
+        self._next_chat_slot = {}       # chat_id -> monotonic time of its next allowed send
+        self._paused_until = 0.0
+
+    @property
+    def pending(self):
+        return len(self._unsettled)
+
+    async def submit(self, chat_id):
+        outcome = asyncio.get_running_loop().create_future()
+        self._unsettled.add(outcome)
+        outcome.add_done_callback(self._unsettled.discard)
+        self._queue.put_nowait((chat_id, 1, outcome))
+        return outcome
+
+    def _retry_later(self, chat_id, attempt, outcome, delay):
+        self.retried += 1
+        loop = asyncio.get_running_loop()
+
+        def requeue():
+            self._retry_handles.discard(handle)
+            self._queue.put_nowait((chat_id, attempt + 1, outcome))
+
+        handle = loop.call_later(delay, requeue)
+        self._retry_handles.add(handle)
+
+    async def _wait_for_slot(self, chat_id):
+        while True:
+            now = time.monotonic()
+            wait = max(self._paused_until, self._next_chat_slot.get(chat_id, 0.0)) - now
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        self._next_chat_slot[chat_id] = now + self.per_chat_interval
+        await self._bucket.acquire()
+
+    def _prune_chat_slots(self):
+        now = time.monotonic()
+        for chat_id in [c for c, t in self._next_chat_slot.items() if t <= now]:
+            del self._next_chat_slot[chat_id]
+
+    async def _worker(self):
+        while True:
+            chat_id, attempt, outcome = await self._queue.get()
+            try:
+                if outcome.done():
+                    continue            # cancelled while queued
+                await self._wait_for_slot(chat_id)
+                await self.send(chat_id)
+                self.sent += 1
+                _settle(outcome, True)
+            except RetryAfter as e:
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self._retry_later(chat_id, attempt - 1, outcome, delay)   # flood control doesn't use up an attempt
+            except BadRequest as e:
+                self.failed += 1
+                print(f"Failed reminder to {chat_id}: {e}")
+                _settle(outcome, False)
+            except NetworkError as e:
+                if attempt >= self.max_attempts:
+                    self.failed += 1
+                    print(f"Failed reminder to {chat_id}: {e}")
+                    if not outcome.done():
+                        outcome.set_exception(e)
+                else:
+                    self._retry_later(chat_id, attempt, outcome, 2 ** attempt)
+            except Exception as e:
+                self.failed += 1
+                print(f"Failed reminder to {chat_id}: {e}")
+                _settle(outcome, False)
+            finally:
+                self._queue.task_done()
+                if len(self._next_chat_slot) > 10000:
+                    self._prune_chat_slots()
+
+    async def run(self):
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            for handle in self._retry_handles:
+                handle.cancel()
+            for outcome in list(self._unsettled):
+                outcome.cancel()
@@ -0,0 +1,386 @@
+import csv
+import gzip
+import time
+import asyncio
+import zipfile
+import itertools
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import storage
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
+from reportlab.lib.pagesizes import A4
+from reportlab.lib import colors
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from storage import iter_pivoted_entries
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # Parquet export is only offered when pyarrow is installed
+    pa = pq = None
+
+PARQUET_AVAILABLE = pa is not None
+
+# Exports stay in memory up to this size and spill to a temp file beyond it
+SPOOL_MAX_SIZE = 1024 * 1024
+# XLSX/PDF/Parquet rendering runs in this many worker processes; at most
+# EXPORT_QUEUE_LIMIT jobs may be queued or running at once
+EXPORT_WORKERS = 2
+EXPORT_QUEUE_LIMIT = 8
+# Sent exports remembered for re-sending, and for how long
+EXPORT_CACHE_SIZE = 10000
+EXPORT_CACHE_TTL = 7 * 24 * 3600
+# Name of the CSV inside zip archives
+CSV_ARCHIVE_NAME = "daily_tracker.csv"
+# Rows per Parquet record batch
+PARQUET_BATCH_ROWS = 10000
+
+# All writers consume the same rows: (date, value, ...) in date order with a
+# column per parameter and None for missing values, streamed by
+# storage.iter_pivoted_entries.
+
+
+# =======================
+# CSV
+# =======================
+class _EncodingWriter:
+    # csv.writer writes str, the spooled file takes bytes
+    def __init__(self, raw):
+        self.raw = raw
+
+    def write(self, text):
+        return self.raw.write(text.encode("utf-8"))
+
+def write_csv(chat_id, parameters, start_date=None, end_date=None, compression=None):
+    # Blocking: run off the event loop. Rows are streamed from the cursor,
+    # so memory does not grow with the history. compression: None, "gzip"
+    # or "zip" (a single CSV_ARCHIVE_NAME inside). Returns a binary file
+    # positioned at the start; the caller closes it.
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        if compression == "gzip":
+            archive = None
+            raw = gzip.GzipFile(fileobj=out, mode="wb")
+        elif compression == "zip":
+            archive = zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED)
+            raw = archive.open(CSV_ARCHIVE_NAME, "w")
+        else:
+            archive = None
+            raw = out
+        writer = csv.writer(_EncodingWriter(raw), lineterminator="\n")
+        writer.writerow(["date"] + list(parameters))
+        writer.writerows(iter_pivoted_entries(chat_id, parameters, start_date, end_date))
+        if raw is not out:
+            raw.close()
+        if archive is not None:
+            archive.close()
+    except Exception:
+        out.close()
+        raise
+    out.seek(0)
+    return out
+
+
+# =======================
+# XLSX / PDF rendering
+# =======================
+# These run in worker processes and return the finished file as bytes.
+def render_xlsx(chat_id, parameters, start_date=None, end_date=None):
+    # Write-only workbook: rows go from the cursor straight into the sheet's
+    # temp file instead of an in-memory cell model, so memory stays flat
+    # however long the history is
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Daily Tracker')
+    bold = Font(bold=True)
+    header = []
+    for name in ["date"] + list(parameters):
+        cell = WriteOnlyCell(sheet, value=name)
+        cell.font = bold
+        header.append(cell)
+    sheet.append(header)
+    for row in iter_pivoted_entries(chat_id, parameters, start_date, end_date):
+        sheet.append(row)
+    with tempfile.TemporaryFile() as out:
+        workbook.save(out)
+        out.seek(0)
+        return out.read()
+
+# PDF tables are cut into chunks of this many rows. reportlab's layout cost
+# grows much faster than linearly with the size of a single table, while
+# many page-sized tables cost the same per row.
+PDF_ROWS_PER_TABLE = 35
+# Widths of the value text used to size the columns once per document
+PDF_SAMPLE_DATE = "2000-00-00"
+PDF_SAMPLE_VALUE = "10.0"
+PDF_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0,0), (-1,0), colors.lightblue),
+    ('TEXTCOLOR',(0,0),(-1,0),colors.black),
+    ('ALIGN',(0,0),(-1,-1),'CENTER'),
+    ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0,0), (-1,0), 12),
+    ('FONTSIZE', (0,1), (-1,-1), 10),
+    ('BOTTOMPADDING', (0,0), (-1,0), 12),
+    ('BACKGROUND', (0,1), (-1,-1), colors.beige),
+    ('GRID', (0,0), (-1,-1), 1, colors.black),
+])
+_pdf_styles = None
+
+
+def _pdf_heading(text):
+    global _pdf_styles
+    if _pdf_styles is None:
+        _pdf_styles = getSampleStyleSheet()
+    return Paragraph(text, _pdf_styles["Heading1"])
+
+def _pdf_column_widths(header):
+    # Fixed widths keep the columns aligned across chunks and spare reportlab
+    # from measuring every cell of every table
+    widths = []
+    for index, name in enumerate(header):
+        sample = PDF_SAMPLE_DATE if index == 0 else PDF_SAMPLE_VALUE
+        widths.append(max(stringWidth(str(name), 'Helvetica-Bold', 12),
+                          stringWidth(sample, 'Helvetica', 10)) + 12)
+    return widths
+
+def _pdf_tables(header, rows):
+    # Page-sized tables sharing one style and one set of column widths
+    widths = _pdf_column_widths(header)
+    tables = []
+    chunk = []
+    for row in rows:
+        chunk.append(["" if value is None else value for value in row])
+        if len(chunk) == PDF_ROWS_PER_TABLE:
+            tables.append(Table([header] + chunk, colWidths=widths, repeatRows=1, style=PDF_TABLE_STYLE))
+            chunk = []
+    if chunk or not tables:
+        # An empty export still shows its structure
+        tables.append(Table([header] + (chunk or [[""] * len(header)]), colWidths=widths,
+                            repeatRows=1, style=PDF_TABLE_STYLE))
+    return tables
+
+def _build_pdf(title, header, rows):
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    doc.build([_pdf_heading(title)] + _pdf_tables(header, rows))
+    return buffer.getvalue()
+
+def render_pdf(chat_id, parameters, start_date=None, end_date=None):
+    header = ["date"] + list(parameters)
+    rows = iter_pivoted_entries(chat_id, parameters, start_date, end_date)
+    return _build_pdf("Daily Parameter Tracker", header, rows)
+
+def monthly_summary(rows, width):
+    # (date, value, ...) rows in date order -> one (month, average, ...,
+    # days) row per month; averages skip days without a value
+    month = None
+    for row in rows:
+        if row[0][:7] != month:
+            if month is not None:
+                yield _summary_row(month, totals, counts, days)
+            month = row[0][:7]
+            totals = [0] * width
+            counts = [0] * width
+            days = 0
+        days += 1
+        for index, value in enumerate(row[1:]):
+            if value is not None:
+                totals[index] += value
+                counts[index] += 1
+    if month is not None:
+        yield _summary_row(month, totals, counts, days)
+
+def _summary_row(month, totals, counts, days):
+    averages = [round(total / count, 1) if count else None for total, count in zip(totals, counts)]
+    return [month] + averages + [days]
+
+def render_pdf_summary(chat_id, parameters, start_date=None, end_date=None):
+    header = ["month"] + list(parameters) + ["days"]
+    rows = monthly_summary(iter_pivoted_entries(chat_id, parameters, start_date, end_date), len(parameters))
+    return _build_pdf("Daily Parameter Tracker: monthly averages", header, rows)
+
+def render_parquet(chat_id, parameters, start_date=None, end_date=None):
+    # Columnar file with a date32 date column and a nullable int16 column
+    # per parameter, written in record batches straight from the cursor
+    schema = pa.schema([("date", pa.date32())] + [(name, pa.int16()) for name in parameters])
+    sink = pa.BufferOutputStream()
+    rows = iter_pivoted_entries(chat_id, parameters, start_date, end_date)
+    with pq.ParquetWriter(sink, schema, compression="zstd") as writer:
+        while True:
+            batch = list(itertools.islice(rows, PARQUET_BATCH_ROWS))
+            if not batch:
+                break
+            columns = list(zip(*batch))
+            arrays = [pa.array(columns[0], pa.string()).cast(pa.date32())]
+            arrays += [pa.array(column, pa.int16()) for column in columns[1:]]
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+    return sink.getvalue().to_pybytes()
+
+RENDERERS = {
+    "xlsx": render_xlsx,
+    "pdf": render_pdf,
+    "pdf summary": render_pdf_summary,
+}
+if PARQUET_AVAILABLE:
+    RENDERERS["parquet"] = render_parquet
+
+def _init_worker(db_file, shard_count):
+    # Renderers that read the DB themselves need the parent's settings
+    storage.DB_FILE = db_file
+    storage.SHARD_COUNT = shard_count
+
+def _render_job(fmt, *args):
+    started = time.perf_counter()
+    data = RENDERERS[fmt](*args)
+    return data, time.perf_counter() - started
+
+
+# =======================
+# Export jobs
+# =======================
+class ExportQueueFull(Exception):
+    pass
+
+
+class ExportJobs:
+    # Renders exports in a bounded process pool so a large export never
+    # blocks the event loop. A user asking for the same export (format and
+    # `variant`, e.g. the date range) while it is still rendering joins the
+    # running job instead of starting another; beyond `max_pending` jobs new
+    # ones are refused.
+    def __init__(self, workers=EXPORT_WORKERS, max_pending=EXPORT_QUEUE_LIMIT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.deduplicated = 0
+        self.render_seconds = 0.0       # total time spent rendering in workers
+        self.max_render_seconds = 0.0
+        self.wait_seconds = 0.0         # total time jobs spent queued
+        self._executor = None
+        self._jobs = {}                 # (user_id, fmt, variant) -> future of (bytes, render seconds)
+
+    @property
+    def pending(self):
+        return len(self._jobs)
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn: the bot process has DB and executor threads that must
+            # not be forked
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=_init_worker,
+                                                 initargs=(storage.DB_FILE, storage.SHARD_COUNT))
+        return self._executor
+
+    async def render(self, user_id, fmt, *args, variant=None):
+        key = (user_id, fmt, variant)
+        job = self._jobs.get(key)
+        if job is not None:
+            self.deduplicated += 1
+            return (await asyncio.shield(job))[0]
+        if len(self._jobs) >= self.max_pending:
+            self.rejected += 1
+            raise ExportQueueFull(f"{len(self._jobs)} exports already pending")
+
+        submitted = time.perf_counter()
+        job = asyncio.get_running_loop().run_in_executor(self._get_executor(), _render_job, fmt, *args)
+        self._jobs[key] = job
+        try:
+            data, render_seconds = await asyncio.shield(job)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            if self._jobs.get(key) is job:
+                del self._jobs[key]
+        waited = max(0.0, time.perf_counter() - submitted - render_seconds)
+        self.completed += 1
+        self.render_seconds += render_seconds
+        self.max_render_seconds = max(self.max_render_seconds, render_seconds)
+        self.wait_seconds += waited
+        print(f"Rendered {fmt} export for {user_id} in {render_seconds:.2f}s "
+              f"(queued {waited:.2f}s, {len(data)} bytes)")
+        return data
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "deduplicated": self.deduplicated,
+            "avg_render_seconds": self.render_seconds / self.completed if self.completed else 0.0,
+            "max_render_seconds": self.max_render_seconds,
+            "avg_wait_seconds": self.wait_seconds / self.completed if self.completed else 0.0,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+
+# =======================
+# Sent export cache
+# =======================
+class ExportCache:
+    # (user_id, fmt, entries version, columns) -> Telegram file_id of the
+    # document already sent for exactly that data. A hit re-sends by file_id,
+    # skipping the query, rendering and upload. Only ids are kept (the files
+    # stay on Telegram's servers); entries are evicted LRU beyond `max_size`
+    # and after `ttl` seconds, and a newer version of the same user's format
+    # replaces the older one.
+    def __init__(self, max_size=EXPORT_CACHE_SIZE, ttl=EXPORT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> (expires_at, file_id)
+        self._latest = {}               # (user_id, fmt) -> key
+
+    def get(self, key):
+        item = self._entries.get(key)
+        if item is not None and item[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[1]
+        if item is not None:
+            self.discard(key)
+        self.misses += 1
+        return None
+
+    def put(self, key, file_id):
+        previous = self._latest.get(key[:2])
+        if previous is not None and previous != key:
+            self._entries.pop(previous, None)
+        self._latest[key[:2]] = key
+        self._entries[key] = (time.monotonic() + self.ttl, file_id)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            old_key, _ = self._entries.popitem(last=False)
+            if self._latest.get(old_key[:2]) == old_key:
+                del self._latest[old_key[:2]]
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+        if self._latest.get(key[:2]) == key:
+            del self._latest[key[:2]]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,91 @@
+# Offline tool: split or merge the SQLite shards used by storage.py.
+#
+#   python rebalance_shards.py NEW_SHARD_COUNT
+#
+# Stop the bot first. Every user-scoped row is moved to the shard it belongs
+# to under the new count, then the new count is recorded in shard 0. Rows are
+# copied before they are deleted from their old shard, so an interrupted run
+# can simply be started again. Afterwards set storage.SHARD_COUNT to the new
+# value.
+
+import os
+import sys
+import storage
+
+
+def _current_shard_count():
+    with storage.get_pool(storage.shard_path(0)).connection() as conn:
+        row = conn.execute("SELECT value FROM storage_meta WHERE key='shard_count'").fetchone()
+    return int(row[0]) if row else storage.SHARD_COUNT
+
+
+def _move_rows(src, dst_path, target, new_count):
+    conn = storage._connect(src)
+    conn.create_function("shard_of", 1, lambda key: storage.shard_for(key, new_count),
+                         deterministic=True)
+    conn.execute("ATTACH DATABASE ? AS dst", (dst_path,))
+    moved = 0
+    try:
+        with conn:
+            for table, key in storage.SHARDED_TABLES.items():
+                where = f"shard_of({key}) = {target}"
+                if table == "entry_values":
+                    # param_id is local to each shard, so map it through the name
+                    conn.execute(f"""
+                    INSERT OR IGNORE INTO dst.parameter_names (name)
+                    SELECT DISTINCT p.name FROM main.entry_values v
+                    JOIN main.parameter_names p ON p.param_id = v.param_id
+                    WHERE {where}
+                    """)
+                    cur = conn.execute(f"""
+                    INSERT OR REPLACE INTO dst.entry_values (chat_id, day, param_id, value)
+                    SELECT v.chat_id, v.day, dp.param_id, v.value FROM main.entry_values v
+                    JOIN main.parameter_names sp ON sp.param_id = v.param_id
+                    JOIN dst.parameter_names dp ON dp.name = sp.name
+                    WHERE {where}
+                    """)
+                else:
+                    cur = conn.execute(f"INSERT OR REPLACE INTO dst.{table} SELECT * FROM main.{table} WHERE {where}")
+                moved += cur.rowcount
+                conn.execute(f"DELETE FROM main.{table} WHERE {where}")
+    finally:
+        conn.execute("DETACH DATABASE dst")
+        conn.close()
+    return moved
+
+
+def rebalance(new_count):
+    old_count = _current_shard_count()
+    # Make sure every shard of both layouts exists and is fully migrated
+    for index in range(max(old_count, new_count)):
+        with storage.get_pool(storage.shard_path(index)).connection() as conn:
+            storage.migrate(conn)
+    storage.close_db()
+
+    for source in range(old_count):
+        src = storage.shard_path(source)
+        for target in range(new_count):
+            if target == source:
+                continue
+            moved = _move_rows(src, storage.shard_path(target), target, new_count)
+            if moved:
+                print(f"Moved {moved} rows from shard {source} to shard {target}")
+
+    with storage.get_pool(storage.shard_path(0)).connection() as conn:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('shard_count', ?)",
+                         (str(new_count),))
+    storage.close_db()
+
+    print(f"Rebalanced {old_count} -> {new_count} shard(s). Set storage.SHARD_COUNT = {new_count}.")
+    for index in range(new_count, old_count):
+        path = storage.shard_path(index)
+        if os.path.exists(path):
+            print(f"{path} is now empty and can be removed.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or not sys.argv[1].isdigit() or int(sys.argv[1]) < 1:
+        print("Usage: python rebalance_shards.py NEW_SHARD_COUNT")
+        sys.exit(1)
+    rebalance(int(sys.argv[1]))
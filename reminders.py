@@ -0,0 +1,442 @@
+import os
+import uuid
+import socket
+import asyncio
+import heapq
+import functools
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from storage import (
+    get_all_users_with_reminders_async, add_settings_listener, remove_settings_listener,
+    claim_reminders_async, unclaim_reminders_async, filter_unrated_reminders_async, prune_reminder_ledger_async, prune_settings_changes_async,
+    acquire_reminder_leases_async, release_reminder_leases_async,
+    get_settings_changes_async, reload_user_settings_async, partition_for, LEASE_SECONDS,
+)
+
+# Longest the scheduler sleeps without re-checking its heap
+MAX_SLEEP = 60
+# Leases are renewed (and settings changes from other processes picked up)
+# this often; it must stay well below LEASE_SECONDS
+LEASE_RENEW_INTERVAL = LEASE_SECONDS / 3
+# Ledger rows older than this many days are pruned about once an hour
+LEDGER_RETENTION_DAYS = 3
+PRUNE_INTERVAL = 3600
+# How far ahead ZoneClock looks for the next UTC offset change
+TRANSITION_SEARCH_DAYS = 400
+# On shutdown, queued reminders get this long to go out before the rest are
+# handed back to the ledger (well below LEASE_SECONDS)
+SHUTDOWN_DRAIN_SECONDS = 10
+
+
+# The fire-time helpers return (UTC instant, local day of the slot). A time
+# skipped by a DST change fires just after the gap, which can be past local
+# midnight, yet it is still that day's reminder: the ledger and the "already
+# rated" check key on the slot's day, not on the date of the instant.
+def next_fire_time(reminder_time, tz, after):
+    # First UTC instant strictly after `after` at which it is `reminder_time`
+    # ("HH:MM") local time in `tz`.
+    h, m = map(int, reminder_time.split(':'))
+    local_day = after.astimezone(tz).date()
+    for offset in range(3):
+        day = local_day + timedelta(days=offset)
+        candidate = datetime(day.year, day.month, day.day, h, m, tzinfo=tz).astimezone(timezone.utc)
+        if candidate > after:
+            return candidate, day
+    raise ValueError(f"no upcoming time for {reminder_time} in {tz}")
+
+
+def previous_fire_time(reminder_time, tz, before):
+    # Last UTC instant at or before `before` at which it was `reminder_time`
+    h, m = map(int, reminder_time.split(':'))
+    local_day = before.astimezone(tz).date()
+    for offset in range(3):
+        day = local_day - timedelta(days=offset)
+        candidate = datetime(day.year, day.month, day.day, h, m, tzinfo=tz).astimezone(timezone.utc)
+        if candidate <= before:
+            return candidate, day
+    raise ValueError(f"no previous time for {reminder_time} in {tz}")
+
+
+class ZoneClock:
+    # Per-timezone cache of the current UTC offset and the window it is valid
+    # for (between the surrounding DST/offset transitions). Converting "HH:MM
+    # local" into a UTC instant is then plain arithmetic; only reminders near
+    # a transition fall back to a full ZoneInfo conversion.
+    def __init__(self, name):
+        self.name = name
+        self.tz = ZoneInfo(name)
+        self.offset = None
+        self.valid_from = None
+        self.valid_until = None
+
+    def _transition(self, at, step):
+        # Steps a day at a time (step=1 forwards, -1 backwards) to the nearest
+        # offset change, then bisects it to the minute. Returns the first
+        # instant of the later offset, or the search limit if there is none.
+        inside = at
+        for _ in range(TRANSITION_SEARCH_DAYS):
+            outside = inside + timedelta(days=step)
+            if outside.astimezone(self.tz).utcoffset() != self.offset:
+                break
+            inside = outside
+        else:
+            return inside
+        while abs(outside - inside) > timedelta(minutes=1):
+            middle = inside + (outside - inside) / 2
+            if middle.astimezone(self.tz).utcoffset() == self.offset:
+                inside = middle
+            else:
+                outside = middle
+        return max(inside, outside).replace(second=0, microsecond=0)
+
+    def _refresh(self, at):
+        self.offset = at.astimezone(self.tz).utcoffset()
+        self.valid_from = self._transition(at, -1)
+        self.valid_until = self._transition(at, 1)
+
+    def _ensure(self, at):
+        if self.offset is None or not self.valid_from <= at < self.valid_until:
+            self._refresh(at)
+
+    def local_date(self, at):
+        self._ensure(at)
+        return (at + self.offset).date()
+
+    def next_fire(self, reminder_time, after):
+        self._ensure(after)
+        h, m = map(int, reminder_time.split(':'))
+        local_day = (after + self.offset).date()
+        for offset in range(2):
+            day = local_day + timedelta(days=offset)
+            candidate = datetime(day.year, day.month, day.day, h, m, tzinfo=timezone.utc) - self.offset
+            if offset == 0:
+                first = candidate
+            if candidate > after:
+                break
+        # Within a day after a transition the local time may not exist or
+        # exist twice, which plain arithmetic gets wrong
+        if self.valid_from + timedelta(days=1) <= first and candidate < self.valid_until:
+            return candidate, day
+        return next_fire_time(reminder_time, self.tz, after)
+
+
+class SystemClock:
+    # Time source of the scheduler. bench_scheduler.py substitutes a
+    # simulated clock to replay a whole day in seconds.
+    def now(self):
+        return datetime.now(timezone.utc)
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    async def wait(self, event, timeout):
+        # Until the event is set or the timeout passes
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class ReminderGroup:
+    # All users of one timezone with the same reminder slot fire together
+    __slots__ = ("users", "generation")
+
+    def __init__(self, generation):
+        self.users = set()
+        self.generation = generation
+
+
+class ReminderScheduler:
+    # Keeps a min-heap of upcoming reminder instants (UTC) and sleeps until
+    # the earliest one, so a tick only costs as much as the reminders that
+    # are actually due. Users are grouped by (timezone, slot): each group is a
+    # single heap entry and its local date is computed once per firing.
+    # Settings changes move users between groups incrementally.
+    #
+    # Several schedulers (bot process and/or standalone workers) can run at
+    # once: each only handles users in the reminder partitions it holds a
+    # lease on. Every reminder is also claimed in the on-disk delivery ledger
+    # before it is sent, keyed by user, slot and the user's local date, so it
+    # goes out once even while a lease changes hands. Lease rows record how
+    # far each partition was processed; whoever picks a partition up (after a
+    # restart or a dead worker) catches up exactly the reminders missed since.
+    #
+    # A claimed reminder stays outstanding until it is delivered: failed sends
+    # are retried for the rest of the user's local day, and the progress
+    # written to the leases stays just before the earliest outstanding one.
+    # On shutdown whatever could not be sent in time is un-claimed, so the
+    # next owner's catch-up sends it.
+    def __init__(self, send, owner=None, clock=None):
+        # async send(user_id): either delivers before returning or returns a
+        # future of the outcome, like ReminderDispatcher.submit
+        self.send = send
+        self.clock = clock or SystemClock()
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.partitions = set()         # reminder partitions currently leased
+        self.processed_until = None     # every reminder due up to here was handed out
+        self.suppressed = 0             # reminders skipped because the user already rated that day
+        self._outstanding = {}          # (user_id, slot, local_date) -> (fire_at, tz_name, outcome)
+        self._failed = set()            # outstanding reminders to send again
+        self._heap = []                 # (fire_at, tz_name, reminder_time, generation, local_day)
+        self._groups = {}               # (tz_name, reminder_time) -> ReminderGroup
+        self._user_groups = {}          # user_id -> [(tz_name, reminder_time), ...]
+        self._zones = {}                # tz_name -> ZoneClock
+        self._generation = 0
+        self._wakeup = asyncio.Event()
+        self._loop = None
+        self._last_prune = None
+        self._changes_cursor = {}
+        self._gained_since = {}         # leased partition not loaded yet -> its processed_until then
+
+    def now(self):
+        return self.clock.now()
+
+    def owns(self, user_id):
+        return partition_for(user_id) in self.partitions
+
+    def _zone(self, tz_name):
+        zone = self._zones.get(tz_name)
+        if zone is None:
+            zone = self._zones[tz_name] = ZoneClock(tz_name)
+        return zone
+
+    def set_user(self, user_id, tz_str, reminders, now=None):
+        # Replace every reminder of this user. Heap entries of groups that
+        # become empty are left in place and skipped later because their
+        # generation no longer matches.
+        for key in self._user_groups.pop(user_id, ()):
+            group = self._groups.get(key)
+            if group is not None:
+                group.users.discard(user_id)
+                if not group.users:
+                    del self._groups[key]
+        if not reminders:
+            return
+        tz_name = tz_str or "UTC"
+        try:
+            zone = self._zone(tz_name)
+        except Exception as e:
+            print(f"Error processing reminders for user {user_id}: {e}")
+            return
+        now = now or self.now()
+        keys = []
+        for reminder_time in reminders:
+            key = (tz_name, reminder_time)
+            group = self._groups.get(key)
+            if group is None:
+                try:
+                    fire_at, day = zone.next_fire(reminder_time, now)
+                except ValueError as e:
+                    print(f"Error processing reminders for user {user_id}: {e}")
+                    continue
+                self._generation += 1
+                group = self._groups[key] = ReminderGroup(self._generation)
+                heapq.heappush(self._heap, (fire_at, tz_name, reminder_time, group.generation, day))
+                # The new entry may be earlier than what run() is sleeping towards
+                self._wakeup.set()
+            group.users.add(user_id)
+            keys.append(key)
+        self._user_groups[user_id] = keys
+
+    def _settings_changed(self, user_id, settings):
+        # Called from the DB writer thread
+        self._loop.call_soon_threadsafe(self._apply_settings, user_id, settings)
+
+    def _apply_settings(self, user_id, settings):
+        if self.owns(user_id):
+            self.set_user(user_id, settings.timezone, settings.reminders)
+
+    async def _send_claimed(self, due):
+        # due: (user_id, reminder_time, local_date) -> (fire_at, tz_name).
+        # Users who already rated on that local date are skipped, then the
+        # ledger drops anything already handed out, e.g. before a restart or
+        # by a previous lease owner
+        unrated = await filter_unrated_reminders_async(list(due))
+        self.suppressed += len(due) - len(unrated)
+        if not unrated:
+            return 0
+        claimed = await claim_reminders_async(unrated)
+        for reminder in claimed:
+            fire_at, tz_name = due[reminder]
+            await self._send(reminder, fire_at, tz_name)
+        return len(claimed)
+
+    async def _send(self, reminder, fire_at, tz_name):
+        user_id, reminder_time, _ = reminder
+        self._outstanding[reminder] = (fire_at, tz_name, None)
+        try:
+            outcome = await self.send(user_id)
+        except Exception as e:
+            print(f"Error processing reminders for user {user_id}: {e}")
+            self._failed.add(reminder)
+            return
+        if asyncio.isfuture(outcome):
+            self._outstanding[reminder] = (fire_at, tz_name, outcome)
+            outcome.add_done_callback(functools.partial(self._settled, reminder))
+            print(f"Queued reminder to {user_id} at {reminder_time}")
+        else:
+            del self._outstanding[reminder]
+
+    def _settled(self, reminder, outcome):
+        if outcome.cancelled():
+            return                      # sending stopped; handed back on shutdown
+        if outcome.exception() is not None:
+            self._failed.add(reminder)
+            return
+        # Delivered, or dropped for good (blocked bot, deleted chat)
+        self._outstanding.pop(reminder, None)
+
+    async def _retry_failed(self, now):
+        # Failed reminders are still claimed by us, so they are sent again
+        # whoever owns their partition now, until the user's local day is over
+        failed, self._failed = self._failed, set()
+        for reminder in failed:
+            fire_at, tz_name, _ = self._outstanding[reminder]
+            zone = self._zone(tz_name)
+            if zone.local_date(now) != zone.local_date(fire_at):
+                del self._outstanding[reminder]
+                continue
+            await self._send(reminder, fire_at, tz_name)
+
+    def _progress(self):
+        # processed_until as written to the leases: just before the earliest
+        # reminder not delivered yet, so a catch-up from there includes it
+        until = self.processed_until
+        if self._outstanding and until is not None:
+            earliest = min(fire_at for fire_at, _, _ in self._outstanding.values())
+            until = min(until, earliest - timedelta(microseconds=1))
+        return until.isoformat() if until else None
+
+    async def run_due(self):
+        now = self.now()
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, tz_name, reminder_time, generation, day = heapq.heappop(self._heap)
+            group = self._groups.get((tz_name, reminder_time))
+            if group is None or group.generation != generation:
+                continue
+            local_date = day.isoformat()
+            for user_id in group.users:
+                due[(user_id, reminder_time, local_date)] = (fire_at, tz_name)
+            next_at, next_day = self._zones[tz_name].next_fire(reminder_time, fire_at)
+            heapq.heappush(self._heap, (next_at, tz_name, reminder_time, generation, next_day))
+        if due:
+            await self._send_claimed(due)
+        self.processed_until = now
+        return now
+
+    async def catch_up(self, since_by_partition, now):
+        # Reminders that should have fired after their partition's recorded
+        # progress and fired on the user's current local day
+        due = {}
+        for (tz_name, reminder_time), group in self._groups.items():
+            zone = self._zones[tz_name]
+            try:
+                fire_at, day = previous_fire_time(reminder_time, zone.tz, now)
+            except ValueError:
+                continue
+            if zone.local_date(fire_at) != zone.local_date(now):
+                continue
+            for user_id in group.users:
+                since = since_by_partition.get(partition_for(user_id))
+                if since is not None and fire_at > since:
+                    due[(user_id, reminder_time, day.isoformat())] = (fire_at, tz_name)
+        if due:
+            sent = await self._send_claimed(due)
+            print(f"Caught up {sent} missed reminder(s)")
+
+    def _drop_partitions(self, partitions):
+        for user_id in [u for u in self._user_groups if partition_for(u) in partitions]:
+            self.set_user(user_id, None, ())
+
+    async def _apply_leases(self, leases):
+        # A gained partition only counts as held once its users are loaded
+        # and caught up; until then it is retried on every renewal, from the
+        # progress it had when it was first acquired (renewals overwrite it)
+        owned = set(leases)
+        lost = self.partitions - owned
+        gained = owned - self.partitions
+        for partition in set(self._gained_since) - owned:
+            del self._gained_since[partition]
+        if lost:
+            self.partitions -= lost
+            self._drop_partitions(lost)
+        if gained:
+            for partition in gained:
+                self._gained_since.setdefault(partition, leases[partition])
+            now = self.now()
+            try:
+                for user_id, tz_str, reminders in await get_all_users_with_reminders_async(gained):
+                    if partition_for(user_id) in gained:
+                        self.set_user(user_id, tz_str, reminders, now)
+                since = {p: datetime.fromisoformat(self._gained_since[p]) for p in gained if self._gained_since[p]}
+                if since:
+                    await self.catch_up(since, now)
+            except Exception:
+                self._drop_partitions(gained)
+                raise
+            self.partitions |= gained
+            for partition in gained:
+                del self._gained_since[partition]
+        if lost or gained:
+            print(f"Reminder worker {self.owner} now holds {len(self.partitions)} partition(s)")
+
+    async def _poll_settings_changes(self):
+        # Picks up timezone/reminder changes committed by other processes
+        user_ids, self._changes_cursor = await get_settings_changes_async(self._changes_cursor)
+        for user_id in set(user_ids):
+            if self.owns(user_id):
+                self._apply_settings(user_id, await reload_user_settings_async(user_id))
+
+    async def _lease_loop(self):
+        while True:
+            try:
+                await self._apply_leases(await acquire_reminder_leases_async(self.owner, self._progress()))
+                await self._poll_settings_changes()
+                await self._retry_failed(self.now())
+            except Exception as e:
+                print(f"Reminder lease renewal failed for {self.owner}: {e}")
+            await self.clock.sleep(LEASE_RENEW_INTERVAL)
+
+    async def _housekeeping(self, now):
+        if self._last_prune is None or (now - self._last_prune).total_seconds() >= PRUNE_INTERVAL:
+            cutoff = (now - timedelta(days=LEDGER_RETENTION_DAYS)).date()
+            await prune_reminder_ledger_async(cutoff)
+            await prune_settings_changes_async(now.timestamp() - LEDGER_RETENTION_DAYS * 86400)
+            self._last_prune = now
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        add_settings_listener(self._settings_changed)
+        lease_task = asyncio.create_task(self._lease_loop())
+        try:
+            while True:
+                now = await self.run_due()
+                await self._housekeeping(now)
+                delay = MAX_SLEEP
+                if self._heap:
+                    delay = min(delay, max(0.0, (self._heap[0][0] - self.now()).total_seconds()))
+                self._wakeup.clear()
+                await self.clock.wait(self._wakeup, delay)
+        finally:
+            lease_task.cancel()
+            remove_settings_listener(self._settings_changed)
+            await self._hand_back()
+
+    async def _hand_back(self):
+        # Give queued reminders a last chance to go out (the sender must still
+        # be running), then un-claim the undelivered ones and release the
+        # leases with progress kept before them
+        pending = [outcome for _, _, outcome in self._outstanding.values() if outcome is not None]
+        if pending:
+            await asyncio.wait(pending, timeout=SHUTDOWN_DRAIN_SECONDS)
+            for outcome in pending:
+                outcome.cancel()
+        processed = self._progress()
+        try:
+            if self._outstanding:
+                await unclaim_reminders_async(list(self._outstanding))
+                print(f"Handed back {len(self._outstanding)} undelivered reminder(s)")
+            await release_reminder_leases_async(self.owner, processed)
+        except Exception as e:
+            print(f"Could not release reminder leases for {self.owner}: {e}")
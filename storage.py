@@ -0,0 +1,1161 @@
+import os
+import sqlite3
+import json
+import queue
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date as _date
+
+DB_FILE = "mood_tracker.db"
+POOL_SIZE = 4
+# Users are spread over SHARD_COUNT SQLite files. Changing it requires
+# moving the data first with rebalance_shards.py.
+SHARD_COUNT = 1
+# Reminder users are split into this many partitions; each reminder worker
+# holds leases on a share of them (see acquire_reminder_leases).
+REMINDER_PARTITIONS = 64
+LEASE_SECONDS = 30
+
+# =======================
+# Connection pool
+# =======================
+# Every connection is opened once and kept for the life of the process.
+# WAL lets readers run alongside the single writer, and synchronous=NORMAL
+# only fsyncs on checkpoints instead of on every commit.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",      # ~16 MB page cache per connection
+    "PRAGMA mmap_size=268435456",    # 256 MB memory-mapped reads
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+# sqlite3 keeps a per-connection LRU of prepared statements keyed by SQL text,
+# so the helpers below use constant query strings to get statement reuse.
+STATEMENT_CACHE_SIZE = 256
+
+
+def _connect(path):
+    conn = sqlite3.connect(
+        path,
+        timeout=5.0,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._all = []
+        # parameter name -> param_id, filled lazily from parameter_names
+        self.param_ids = {}
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._all) < self.size:
+                conn = _connect(self.path)
+                self._all.append(conn)
+                return conn
+        return self._idle.get()
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def close(self):
+        with self._lock:
+            conns, self._all = self._all, []
+        for conn in conns:
+            conn.close()
+        self._idle = queue.LifoQueue()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=None):
+    path = path or DB_FILE
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = _pools[path] = ConnectionPool(path)
+        return pool
+
+
+def close_db():
+    _shutdown_executors()
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+# =======================
+# Sharding
+# =======================
+# Every user-scoped row lives in the shard picked by its user/chat id. Shard 0
+# is DB_FILE itself, so a single-shard deployment keeps using the original
+# mood_tracker.db; shard N>0 is mood_tracker.shardN.db next to it.
+def shard_for(user_id, shard_count=None):
+    return user_id % (shard_count or SHARD_COUNT)
+
+
+def shard_path(index):
+    if index == 0:
+        return DB_FILE
+    stem, ext = os.path.splitext(DB_FILE)
+    return f"{stem}.shard{index}{ext}"
+
+
+def _pool_for(user_id):
+    return get_pool(shard_path(shard_for(user_id)))
+
+
+def all_shard_pools():
+    return [get_pool(shard_path(index)) for index in range(SHARD_COUNT)]
+
+
+def _group_by_shard(rows):
+    # rows whose first element is a user/chat id -> {shard: [rows]}
+    groups = {}
+    for row in rows:
+        groups.setdefault(shard_for(row[0]), []).append(row)
+    return groups
+
+
+def _fetchone(user_id, query, params=()):
+    with _pool_for(user_id).connection() as conn:
+        return conn.execute(query, params).fetchone()
+
+
+def _fetchall(user_id, query, params=()):
+    with _pool_for(user_id).connection() as conn:
+        return conn.execute(query, params).fetchall()
+
+
+def _fetchall_all_shards(query, params=()):
+    rows = []
+    for pool in all_shard_pools():
+        with pool.connection() as conn:
+            rows.extend(conn.execute(query, params).fetchall())
+    return rows
+
+
+def _execute(user_id, query, params=()):
+    with _pool_for(user_id).connection() as conn:
+        with conn:
+            conn.execute(query, params)
+
+
+def _executemany(user_id, query, seq_of_params):
+    with _pool_for(user_id).connection() as conn:
+        with conn:
+            return conn.executemany(query, seq_of_params).rowcount
+
+
+@contextmanager
+def _transaction(user_id):
+    with _pool_for(user_id).connection() as conn:
+        with conn:
+            yield conn
+
+# =======================
+# Schema migrations
+# =======================
+# The schema version lives in PRAGMA user_version. Each migration upgrades
+# the database by exactly one version and runs in its own transaction, so an
+# existing mood_tracker.db is brought up to date in place at startup.
+def _migration_base_schema(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS entries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        date TEXT,
+        parameter TEXT,
+        value INTEGER
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_settings (
+        user_id INTEGER PRIMARY KEY,
+        timezone TEXT DEFAULT 'UTC',
+        reminders TEXT,
+        parameters TEXT
+    )
+    """)
+
+def _migration_entries_index(conn):
+    # Covering index: exports are answered from the index alone.
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_entries_chat_date
+    ON entries (chat_id, date, parameter, value)
+    """)
+
+def _migration_normalized_settings(conn):
+    # Parameters and reminders move out of the JSON columns of user_settings
+    # into one row per item, so single items can be added or removed without
+    # rewriting the settings row.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_parameters (
+        user_id INTEGER NOT NULL,
+        parameter TEXT NOT NULL,
+        PRIMARY KEY (user_id, parameter)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_reminders (
+        user_id INTEGER NOT NULL,
+        reminder_time TEXT NOT NULL,
+        PRIMARY KEY (user_id, reminder_time)
+    ) WITHOUT ROWID
+    """)
+    rows = conn.execute("SELECT user_id, parameters, reminders FROM user_settings").fetchall()
+    conn.executemany(
+        "INSERT OR IGNORE INTO user_parameters (user_id, parameter) VALUES (?, ?)",
+        [(user_id, p) for user_id, params, _ in rows for p in _parse_json_list(params)])
+    conn.executemany(
+        "INSERT OR IGNORE INTO user_reminders (user_id, reminder_time) VALUES (?, ?)",
+        [(user_id, r) for user_id, _, reminders in rows for r in _parse_json_list(reminders)])
+    # The legacy JSON columns stay in the table but are no longer read
+    conn.execute("UPDATE user_settings SET parameters = NULL, reminders = NULL")
+
+def _migration_compact_entries(conn):
+    # entries used to repeat the parameter name and an ISO date string in
+    # every row. Values now live in a clustered WITHOUT ROWID table keyed by
+    # (chat_id, day, param_id), with parameter names interned in
+    # parameter_names and days counted from 1970-01-01. The old table is
+    # replaced by a view with the same columns.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS parameter_names (
+        param_id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS entry_values (
+        chat_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        param_id INTEGER NOT NULL,
+        value INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, day, param_id)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    INSERT OR IGNORE INTO parameter_names (name)
+    SELECT DISTINCT parameter FROM entries WHERE parameter IS NOT NULL
+    """)
+    # Same-day duplicates collapse onto the clustered key; the latest one wins
+    conn.execute("""
+    INSERT OR REPLACE INTO entry_values (chat_id, day, param_id, value)
+    SELECT e.chat_id, CAST(julianday(e.date) - 2440587.5 AS INTEGER), p.param_id, e.value
+    FROM entries e JOIN parameter_names p ON p.name = e.parameter
+    WHERE e.chat_id IS NOT NULL AND e.value IS NOT NULL AND julianday(e.date) IS NOT NULL
+    ORDER BY e.id
+    """)
+    conn.execute("DROP TABLE entries")
+    conn.execute("""
+    CREATE VIEW entries AS
+    SELECT v.chat_id, v.day, date(v.day + 2440587.5) AS date, p.name AS parameter, v.value
+    FROM entry_values v JOIN parameter_names p ON p.param_id = v.param_id
+    """)
+
+def _migration_storage_meta(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS storage_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    """)
+
+def _migration_reminder_ledger(conn):
+    # One row per reminder handed out, keyed by the user's local date
+    # (as a day number), so restarts neither repeat nor lose reminders.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS reminder_ledger (
+        user_id INTEGER NOT NULL,
+        slot TEXT NOT NULL,
+        local_day INTEGER NOT NULL,
+        PRIMARY KEY (user_id, slot, local_day)
+    ) WITHOUT ROWID
+    """)
+
+def _migration_reminder_leases(conn):
+    # Lease rows are only used in shard 0. processed_until is how far the
+    # owner has sent that partition's reminders, so a worker taking it over
+    # knows what to catch up.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS reminder_leases (
+        partition INTEGER PRIMARY KEY,
+        owner TEXT,
+        expires_at REAL NOT NULL DEFAULT 0,
+        processed_until TEXT
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS reminder_workers (
+        owner TEXT PRIMARY KEY,
+        expires_at REAL NOT NULL
+    )
+    """)
+    # Per-shard feed of timezone/reminder changes, polled by reminder
+    # workers running in other processes
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS settings_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        changed_at REAL NOT NULL
+    )
+    """)
+
+def _migration_user_activity(conn):
+    # Local date (day number) of each user's latest Estimate, so reminders
+    # for users who already rated that day can be skipped
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_activity (
+        user_id INTEGER PRIMARY KEY,
+        last_rated_day INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+
+def _migration_entry_versions(conn):
+    # Bumped on every write to a chat's entries; export caches key on it
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS entry_versions (
+        chat_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+    # Chats with existing history start at version 1, not "never had entries"
+    conn.execute("INSERT OR IGNORE INTO entry_versions (chat_id, version) SELECT DISTINCT chat_id, 1 FROM entry_values")
+
+def _migration_user_exports(conn):
+    # Day of each user's latest export, for "since last export"
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_exports (
+        user_id INTEGER PRIMARY KEY,
+        last_export_day INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+
+def _migration_drop_reminder_time_index(conn):
+    # The scheduler loads reminders per user, so this index was only ever
+    # written to. Databases that ran migration 3 before it was dropped
+    # from there still have it.
+    conn.execute("DROP INDEX IF EXISTS idx_user_reminders_time")
+
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_entries_index,
+    _migration_normalized_settings,
+    _migration_compact_entries,
+    _migration_storage_meta,
+    _migration_reminder_ledger,
+    _migration_reminder_leases,
+    _migration_user_activity,
+    _migration_entry_versions,
+    _migration_user_exports,
+    _migration_drop_reminder_time_index,
+]
+
+# Tables holding per-user rows and the column that picks their shard.
+# rebalance_shards.py moves exactly these.
+SHARDED_TABLES = {
+    "user_settings": "user_id",
+    "user_parameters": "user_id",
+    "user_reminders": "user_id",
+    "entry_values": "chat_id",
+    "reminder_ledger": "user_id",
+    "user_activity": "user_id",
+    "entry_versions": "chat_id",
+    "user_exports": "user_id",
+}
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn):
+    version = get_schema_version(conn)
+    for number in range(version + 1, len(MIGRATIONS) + 1):
+        migration = MIGRATIONS[number - 1]
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process starting at the same time may have applied it
+            # while we waited for the write lock
+            if get_schema_version(conn) >= number:
+                conn.rollback()
+                continue
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        print(f"Applied DB migration {number}: {migration.__name__.removeprefix('_migration_')}")
+    return get_schema_version(conn)
+
+# =======================
+# User settings cache
+# =======================
+UserSettings = namedtuple("UserSettings", ["timezone", "reminders", "parameters"])
+
+
+class SettingsCache:
+    # Bounded LRU with a TTL. Reads fill it from SQLite, the set_user_*
+    # helpers update it write-through after their commit. The generation
+    # counter stops a read that raced with a write from caching stale data.
+    def __init__(self, max_size=10000, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def lookup(self, user_id):
+        with self._lock:
+            item = self._entries.get(user_id)
+            if item is not None and item[0] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return item[1], self._generation
+            self.misses += 1
+            return None, self._generation
+
+    def peek(self, user_id):
+        # Hit-only lookup used by the async fast path; misses are counted by
+        # the lookup() that follows on the DB thread.
+        with self._lock:
+            item = self._entries.get(user_id)
+            if item is None or item[0] <= time.monotonic():
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return item[1]
+
+    def store(self, user_id, settings, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[user_id] = (time.monotonic() + self.ttl, settings)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def apply(self, user_id, change):
+        # change: function UserSettings -> UserSettings, applied to a cached entry
+        with self._lock:
+            self._generation += 1
+            item = self._entries.get(user_id)
+            if item is not None:
+                self._entries[user_id] = (time.monotonic() + self.ttl, change(item[1]))
+
+    def update(self, user_id, **fields):
+        self.apply(user_id, lambda settings: settings._replace(**fields))
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+settings_cache = SettingsCache()
+
+# Callbacks run after a user's timezone or reminders were committed, as
+# callback(user_id, settings). They are called on the DB writer thread.
+_settings_listeners = []
+
+
+def add_settings_listener(callback):
+    _settings_listeners.append(callback)
+
+
+def remove_settings_listener(callback):
+    if callback in _settings_listeners:
+        _settings_listeners.remove(callback)
+
+
+def _settings_changed(user_id):
+    if not _settings_listeners:
+        return
+    settings = get_user_settings(user_id)
+    for callback in list(_settings_listeners):
+        try:
+            callback(user_id, settings)
+        except Exception as e:
+            print(f"Settings listener failed for {user_id}: {e}")
+
+# =======================
+# Database functions
+# =======================
+def init_db():
+    # Shard 0 remembers the layout the data was written with, so a changed
+    # SHARD_COUNT can't silently route users to the wrong file
+    with get_pool(shard_path(0)).connection() as conn:
+        migrate(conn)
+        with conn:
+            # OR IGNORE: a process starting alongside may have recorded it first
+            conn.execute("INSERT OR IGNORE INTO storage_meta (key, value) VALUES ('shard_count', ?)",
+                         (str(SHARD_COUNT),))
+            row = conn.execute("SELECT value FROM storage_meta WHERE key='shard_count'").fetchone()
+            if int(row[0]) != SHARD_COUNT:
+                raise RuntimeError(
+                    f"Database was written with {row[0]} shard(s) but SHARD_COUNT is {SHARD_COUNT}; "
+                    f"run rebalance_shards.py {SHARD_COUNT} first")
+    for pool in all_shard_pools()[1:]:
+        with pool.connection() as conn:
+            migrate(conn)
+
+_EPOCH_ORDINAL = _date(1970, 1, 1).toordinal()
+
+def to_day_number(date):
+    # 'YYYY-MM-DD' (or a date) -> days since 1970-01-01
+    if isinstance(date, str):
+        date = _date.fromisoformat(date)
+    return date.toordinal() - _EPOCH_ORDINAL
+
+def from_day_number(day):
+    return _date.fromordinal(day + _EPOCH_ORDINAL).isoformat()
+
+def _intern_parameters(conn, pool, names):
+    ids = {name: pool.param_ids[name] for name in names if name in pool.param_ids}
+    missing = [name for name in names if name not in ids]
+    if missing:
+        conn.executemany("INSERT OR IGNORE INTO parameter_names (name) VALUES (?)",
+                         [(name,) for name in missing])
+        for name in missing:
+            ids[name] = conn.execute("SELECT param_id FROM parameter_names WHERE name=?",
+                                     (name,)).fetchone()[0]
+    return ids
+
+def add_entries(rows, rated=()):
+    # rows: iterable of (chat_id, date, parameter, value); rated: iterable of
+    # (user_id, local_date) marking a finished Estimate. Written in one
+    # transaction per shard.
+    rows = list(rows)
+    groups = _group_by_shard(rows)
+    rated_groups = _group_by_shard(rated)
+    for shard in set(groups) | set(rated_groups):
+        _add_shard_entries(get_pool(shard_path(shard)), groups.get(shard, []), rated_groups.get(shard, []))
+    return len(rows)
+
+@contextmanager
+def _synchronous_full(conn):
+    # Ratings are confirmed to the user once committed, so their commits are
+    # fsynced (one fsync per group commit) instead of the pool-wide NORMAL
+    conn.execute("PRAGMA synchronous=FULL")
+    try:
+        yield conn
+    finally:
+        conn.execute("PRAGMA synchronous=NORMAL")
+
+def _add_shard_entries(pool, rows, rated=()):
+    with pool.connection() as conn, _synchronous_full(conn):
+        with conn:
+            ids = _intern_parameters(conn, pool, {row[2] for row in rows})
+            # One value per chat, day and parameter: re-rating a day overwrites it
+            conn.executemany("""INSERT INTO entry_values (chat_id, day, param_id, value) VALUES (?, ?, ?, ?)
+                                ON CONFLICT (chat_id, day, param_id) DO UPDATE SET value = excluded.value""",
+                             [(chat_id, to_day_number(date), ids[parameter], value)
+                              for chat_id, date, parameter, value in rows])
+            conn.executemany("""INSERT INTO entry_versions (chat_id, version) VALUES (?, 1)
+                                ON CONFLICT (chat_id) DO UPDATE SET version = version + 1""",
+                             [(chat_id,) for chat_id in {row[0] for row in rows}])
+            conn.executemany("""INSERT INTO user_activity (user_id, last_rated_day) VALUES (?, ?)
+                                ON CONFLICT (user_id) DO UPDATE
+                                SET last_rated_day = max(last_rated_day, excluded.last_rated_day)""",
+                             [(user_id, to_day_number(local_date)) for user_id, local_date in rated])
+    # Only remember ids once the names are committed
+    pool.param_ids.update(ids)
+    return len(rows)
+
+def add_entry_to_db(chat_id, date, parameter, value):
+    add_entries([(chat_id, date, parameter, value)])
+
+def get_entries_from_db(chat_id, start_date=None, end_date=None):
+    query = "SELECT date, parameter, value FROM entries WHERE chat_id=?"
+    params = [chat_id]
+    if start_date:
+        query += " AND day >= ?"
+        params.append(to_day_number(start_date))
+    if end_date:
+        query += " AND day <= ?"
+        params.append(to_day_number(end_date))
+    query += " ORDER BY day DESC"
+    return _fetchall(chat_id, query, params)
+
+def _lookup_parameters(conn, pool, names):
+    # name -> param_id for names that exist in this shard
+    ids = {name: pool.param_ids[name] for name in names if name in pool.param_ids}
+    for name in names:
+        if name not in ids:
+            row = conn.execute("SELECT param_id FROM parameter_names WHERE name=?", (name,)).fetchone()
+            if row:
+                ids[name] = pool.param_ids[name] = row[0]
+    return ids
+
+@contextmanager
+def _streaming_connection(pool):
+    # Streamed exports hold their connection for as long as the caller takes
+    # to consume the rows, so they open their own instead of tying up the
+    # pool: however many run at once, the shard's writer and the read
+    # executor still find pooled connections
+    conn = _connect(pool.path)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def iter_pivoted_entries(chat_id, parameters, start_date=None, end_date=None, batch_size=1000):
+    # One (date, value, ...) row per day, oldest first, with a column per
+    # name in `parameters` (None where that day has no value). The pivot is
+    # done by SQLite with conditional aggregation over the clustered key and
+    # streamed from the cursor in batches. Only call it off the event loop.
+    pool = _pool_for(chat_id)
+    with _streaming_connection(pool) as conn:
+        ids = _lookup_parameters(conn, pool, parameters)
+        if not ids:
+            return
+        columns = ", ".join("MAX(CASE WHEN param_id = ? THEN value END)" if name in ids else "NULL"
+                            for name in parameters)
+        query = (f"SELECT date(day + 2440587.5), {columns} FROM entry_values"
+                 f" WHERE chat_id = ? AND param_id IN ({', '.join('?' * len(ids))})")
+        params = [ids[name] for name in parameters if name in ids] + [chat_id] + list(ids.values())
+        if start_date:
+            query += " AND day >= ?"
+            params.append(to_day_number(start_date))
+        if end_date:
+            query += " AND day <= ?"
+            params.append(to_day_number(end_date))
+        cursor = conn.execute(query + " GROUP BY day ORDER BY day", params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+def get_pivoted_entries(chat_id, parameters, start_date=None, end_date=None):
+    return list(iter_pivoted_entries(chat_id, parameters, start_date, end_date))
+
+def has_entries(chat_id):
+    return _fetchone(chat_id, "SELECT 1 FROM entry_values WHERE chat_id=? LIMIT 1", (chat_id,)) is not None
+
+def get_entries_version(chat_id):
+    # Changes whenever the chat's entries do; 0 if it never had any
+    row = _fetchone(chat_id, "SELECT version FROM entry_versions WHERE chat_id=?", (chat_id,))
+    return row[0] if row else 0
+
+def get_last_export(user_id):
+    # 'YYYY-MM-DD' of the user's latest export, or None
+    row = _fetchone(user_id, "SELECT last_export_day FROM user_exports WHERE user_id=?", (user_id,))
+    return from_day_number(row[0]) if row else None
+
+def set_last_export(user_id, date):
+    _execute(user_id, """INSERT INTO user_exports (user_id, last_export_day) VALUES (?, ?)
+                         ON CONFLICT (user_id) DO UPDATE SET last_export_day = excluded.last_export_day""",
+             (user_id, to_day_number(date)))
+
+def _parse_json_list(value):
+    if value:
+        try:
+            return tuple(json.loads(value))
+        except json.JSONDecodeError:
+            return ()
+    return ()
+
+def get_user_settings(user_id):
+    settings, generation = settings_cache.lookup(user_id)
+    if settings is None:
+        with _pool_for(user_id).connection() as conn:
+            result = conn.execute("SELECT timezone FROM user_settings WHERE user_id=?",
+                                  (user_id,)).fetchone()
+            reminders = conn.execute(
+                "SELECT reminder_time FROM user_reminders WHERE user_id=? ORDER BY reminder_time",
+                (user_id,)).fetchall()
+            parameters = conn.execute(
+                "SELECT parameter FROM user_parameters WHERE user_id=? ORDER BY parameter",
+                (user_id,)).fetchall()
+        settings = UserSettings(
+            result[0] if result else "UTC",
+            tuple(r[0] for r in reminders),
+            tuple(p[0] for p in parameters),
+        )
+        settings_cache.store(user_id, settings, generation)
+    return settings
+
+def get_user_parameters(user_id):
+    # Parameters are always returned in sorted order
+    return list(get_user_settings(user_id).parameters)
+
+def set_user_parameters(user_id, parameters):
+    parameters = sorted(set(parameters))
+    with _transaction(user_id) as conn:
+        current = {row[0] for row in conn.execute("SELECT parameter FROM user_parameters WHERE user_id=?", (user_id,))}
+        conn.executemany("DELETE FROM user_parameters WHERE user_id=? AND parameter=?",
+                         [(user_id, x) for x in current.difference(parameters)])
+        conn.executemany("""INSERT INTO user_parameters (user_id, parameter) VALUES (?, ?)
+                            ON CONFLICT (user_id, parameter) DO NOTHING""",
+                         [(user_id, x) for x in parameters if x not in current])
+    settings_cache.update(user_id, parameters=tuple(parameters))
+
+def add_user_parameters(user_id, parameters):
+    _executemany(user_id, """INSERT INTO user_parameters (user_id, parameter) VALUES (?, ?)
+                    ON CONFLICT (user_id, parameter) DO NOTHING""",
+                 [(user_id, p) for p in parameters])
+    settings_cache.apply(user_id, lambda settings: settings._replace(
+        parameters=tuple(sorted(set(settings.parameters) | set(parameters)))))
+
+def remove_user_parameter(user_id, parameter):
+    with _transaction(user_id) as conn:
+        removed = conn.execute("DELETE FROM user_parameters WHERE user_id=? AND parameter=?",
+                               (user_id, parameter)).rowcount
+    settings_cache.apply(user_id, lambda settings: settings._replace(
+        parameters=tuple(p for p in settings.parameters if p != parameter)))
+    return removed > 0
+
+def get_user_timezone(user_id):
+    return get_user_settings(user_id).timezone
+
+def _log_settings_change(conn, user_id):
+    conn.execute("INSERT INTO settings_changes (user_id, changed_at) VALUES (?, ?)",
+                 (user_id, time.time()))
+
+def set_user_timezone(user_id, timezone):
+    with _transaction(user_id) as conn:
+        conn.execute("""INSERT INTO user_settings (user_id, timezone) VALUES (?, ?)
+                        ON CONFLICT (user_id) DO UPDATE SET timezone = excluded.timezone""",
+                     (user_id, timezone))
+        _log_settings_change(conn, user_id)
+    settings_cache.update(user_id, timezone=timezone)
+    _settings_changed(user_id)
+
+def get_user_reminders(user_id):
+    return list(get_user_settings(user_id).reminders)
+
+def set_user_reminders(user_id, reminders):
+    reminders = sorted(set(reminders))
+    with _transaction(user_id) as conn:
+        current = {row[0] for row in conn.execute("SELECT reminder_time FROM user_reminders WHERE user_id=?", (user_id,))}
+        conn.executemany("DELETE FROM user_reminders WHERE user_id=? AND reminder_time=?",
+                         [(user_id, x) for x in current.difference(reminders)])
+        conn.executemany("""INSERT INTO user_reminders (user_id, reminder_time) VALUES (?, ?)
+                            ON CONFLICT (user_id, reminder_time) DO NOTHING""",
+                         [(user_id, x) for x in reminders if x not in current])
+        _log_settings_change(conn, user_id)
+    settings_cache.update(user_id, reminders=tuple(reminders))
+    _settings_changed(user_id)
+
+def partition_for(user_id):
+    return user_id % REMINDER_PARTITIONS
+
+def get_all_users_with_reminders(partitions=None):
+    # -> [(user_id, timezone, [reminder_time, ...]), ...], optionally only
+    # for users in the given reminder partitions
+    query = """SELECT r.user_id, COALESCE(s.timezone, 'UTC'), group_concat(r.reminder_time)
+               FROM user_reminders r
+               LEFT JOIN user_settings s ON s.user_id = r.user_id"""
+    params = []
+    if partitions is not None:
+        partitions = sorted(partitions)
+        if not partitions:
+            return []
+        # Same result as Python's % for negative ids
+        query += (f" WHERE ((r.user_id % {REMINDER_PARTITIONS}) + {REMINDER_PARTITIONS}) % {REMINDER_PARTITIONS}"
+                  f" IN ({', '.join('?' * len(partitions))})")
+        params = partitions
+    query += " GROUP BY r.user_id"
+    rows = _fetchall_all_shards(query, params)
+    return [(user_id, tz, times.split(",")) for user_id, tz, times in rows]
+
+# =======================
+# Reminder delivery ledger
+# =======================
+def _claim_shard_reminders(pool, rows):
+    claimed = []
+    with pool.connection() as conn:
+        with conn:
+            for row in rows:
+                user_id, slot, local_date = row
+                cur = conn.execute("INSERT OR IGNORE INTO reminder_ledger (user_id, slot, local_day) VALUES (?, ?, ?)",
+                                   (user_id, slot, to_day_number(local_date)))
+                if cur.rowcount:
+                    claimed.append(row)
+    return claimed
+
+def claim_reminders(rows):
+    # rows: (user_id, slot, local_date). Records them in the ledger and
+    # returns only those that were not recorded yet, i.e. still to be sent.
+    rows = list(rows)
+    claimed = []
+    for shard, shard_rows in _group_by_shard(rows).items():
+        claimed.extend(_claim_shard_reminders(get_pool(shard_path(shard)), shard_rows))
+    return claimed
+
+def _unclaim_shard_reminders(pool, rows):
+    with pool.connection() as conn:
+        with conn:
+            return conn.executemany("DELETE FROM reminder_ledger WHERE user_id=? AND slot=? AND local_day=?",
+                                    [(user_id, slot, to_day_number(local_date))
+                                     for user_id, slot, local_date in rows]).rowcount
+
+def unclaim_reminders(rows):
+    # Hands claimed reminders that were never delivered back, so a later
+    # catch-up can claim and send them
+    return sum(_unclaim_shard_reminders(get_pool(shard_path(shard)), shard_rows)
+               for shard, shard_rows in _group_by_shard(list(rows)).items())
+
+def _shard_last_rated_days(pool, user_ids):
+    days = {}
+    with pool.connection() as conn:
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            days.update(conn.execute(f"""SELECT user_id, last_rated_day FROM user_activity
+                                         WHERE user_id IN ({', '.join('?' * len(chunk))})""", chunk))
+    return days
+
+def filter_unrated_reminders(rows):
+    # rows: (user_id, slot, local_date). Drops reminders for users who
+    # already rated on that local date.
+    rows = list(rows)
+    days = {}
+    for shard, shard_rows in _group_by_shard(rows).items():
+        days.update(_shard_last_rated_days(get_pool(shard_path(shard)), sorted({row[0] for row in shard_rows})))
+    if not days:
+        return rows
+    return [row for row in rows if days.get(row[0], -1) < to_day_number(row[2])]
+
+def _prune_shard_ledger(pool, before_day):
+    with pool.connection() as conn:
+        with conn:
+            return conn.execute("DELETE FROM reminder_ledger WHERE local_day < ?", (before_day,)).rowcount
+
+def prune_reminder_ledger(before_date):
+    return sum(_prune_shard_ledger(pool, to_day_number(before_date)) for pool in all_shard_pools())
+
+# =======================
+# Reminder worker leases
+# =======================
+# Any number of reminder workers may run against the same databases. Each one
+# heartbeats in reminder_workers and holds leases on about
+# REMINDER_PARTITIONS / live workers partitions. Leases that are not renewed
+# within LEASE_SECONDS are taken over by the remaining workers.
+def acquire_reminder_leases(owner, processed_until=None, lease_seconds=LEASE_SECONDS):
+    # Renews this worker's leases, gives back any above its fair share and
+    # claims free or expired ones up to it. Returns {partition: processed_until}
+    # for every partition now owned; for newly claimed partitions that is the
+    # previous owner's progress.
+    now = time.time()
+    expires_at = now + lease_seconds
+    with get_pool(shard_path(0)).connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("""INSERT INTO reminder_workers (owner, expires_at) VALUES (?, ?)
+                            ON CONFLICT (owner) DO UPDATE SET expires_at = excluded.expires_at""",
+                         (owner, expires_at))
+            conn.execute("DELETE FROM reminder_workers WHERE expires_at < ?", (now,))
+            workers = conn.execute("SELECT COUNT(*) FROM reminder_workers").fetchone()[0]
+            fair_share = -(-REMINDER_PARTITIONS // workers)
+
+            # Partitions start out at the heartbeat the single scheduler kept
+            # in storage_meta before leases existed, if any (read once, never written)
+            heartbeat = conn.execute("SELECT value FROM storage_meta WHERE key='reminders_heartbeat'").fetchone()
+            conn.executemany("INSERT OR IGNORE INTO reminder_leases (partition, processed_until) VALUES (?, ?)",
+                             [(p, heartbeat[0] if heartbeat else None) for p in range(REMINDER_PARTITIONS)])
+
+            if processed_until is not None:
+                conn.execute("UPDATE reminder_leases SET expires_at=?, processed_until=? WHERE owner=?",
+                             (expires_at, processed_until, owner))
+            else:
+                conn.execute("UPDATE reminder_leases SET expires_at=? WHERE owner=?", (expires_at, owner))
+            owned = [row[0] for row in conn.execute(
+                "SELECT partition FROM reminder_leases WHERE owner=? ORDER BY partition", (owner,))]
+            # Give back partitions above the fair share so new workers get some
+            conn.executemany("UPDATE reminder_leases SET owner=NULL, expires_at=0 WHERE partition=?",
+                             [(p,) for p in owned[fair_share:]])
+            free = conn.execute("""SELECT partition FROM reminder_leases
+                                   WHERE owner IS NULL OR expires_at < ?
+                                   ORDER BY partition LIMIT ?""",
+                                (now, max(0, fair_share - len(owned)))).fetchall()
+            conn.executemany("UPDATE reminder_leases SET owner=?, expires_at=? WHERE partition=?",
+                             [(owner, expires_at, row[0]) for row in free])
+            leases = dict(conn.execute(
+                "SELECT partition, processed_until FROM reminder_leases WHERE owner=?", (owner,)).fetchall())
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+    return leases
+
+def release_reminder_leases(owner, processed_until=None):
+    with get_pool(shard_path(0)).connection() as conn:
+        with conn:
+            if processed_until is not None:
+                conn.execute("UPDATE reminder_leases SET processed_until=? WHERE owner=?",
+                             (processed_until, owner))
+            conn.execute("UPDATE reminder_leases SET owner=NULL, expires_at=0 WHERE owner=?", (owner,))
+            conn.execute("DELETE FROM reminder_workers WHERE owner=?", (owner,))
+
+def get_settings_changes(cursor):
+    # cursor: {shard: last seen seq}. Returns (user ids changed since, new
+    # cursor). Shards missing from the cursor start at their current end.
+    user_ids = []
+    new_cursor = {}
+    for index, pool in enumerate(all_shard_pools()):
+        with pool.connection() as conn:
+            last = cursor.get(index)
+            if last is None:
+                new_cursor[index] = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM settings_changes").fetchone()[0]
+                continue
+            rows = conn.execute("SELECT seq, user_id FROM settings_changes WHERE seq > ? ORDER BY seq",
+                                (last,)).fetchall()
+        new_cursor[index] = rows[-1][0] if rows else last
+        user_ids.extend(row[1] for row in rows)
+    return user_ids, new_cursor
+
+def _prune_shard_settings_changes(pool, before):
+    with pool.connection() as conn:
+        with conn:
+            return conn.execute("DELETE FROM settings_changes WHERE changed_at < ?", (before,)).rowcount
+
+def reload_user_settings(user_id):
+    # Drops the cached copy first, for changes made by another process
+    settings_cache.invalidate(user_id)
+    return get_user_settings(user_id)
+
+# =======================
+# Async API
+# =======================
+# Handlers must never touch sqlite3 on the event loop. Reads run on a small
+# thread pool and writes are serialized on one writer thread per shard, so a
+# writer always has a pooled connection left and never contends for its
+# shard's write lock, while different shards are written in parallel.
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def _get_executor(kind):
+    with _executors_lock:
+        executor = _executors.get(kind)
+        if executor is None:
+            workers = 1 if kind.startswith("write") else max(1, POOL_SIZE - 1)
+            executor = _executors[kind] = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix=f"db-{kind}")
+        return executor
+
+
+def _shutdown_executors():
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=True)
+
+
+def _run_in(kind, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    return loop.run_in_executor(_get_executor(kind), call)
+
+
+def _offload(kind, func):
+    # Writes go to the writer of the shard owning the first argument (user id)
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        executor_kind = f"write-{shard_for(args[0])}" if kind == "write" else kind
+        return await _run_in(executor_kind, func, *args, **kwargs)
+    wrapper.__name__ = wrapper.__qualname__ = f"{func.__name__}_async"
+    return wrapper
+
+
+async def _write_by_shard(func, rows):
+    # Runs func(pool, shard_rows) on each shard's writer, in parallel
+    groups = _group_by_shard(rows)
+    return await asyncio.gather(*(
+        _run_in(f"write-{shard}", func, get_pool(shard_path(shard)), shard_rows)
+        for shard, shard_rows in groups.items()))
+
+
+async def add_entries_async(rows, rated=()):
+    groups = _group_by_shard(rows)
+    rated_groups = _group_by_shard(rated)
+    return sum(await asyncio.gather(*(
+        _run_in(f"write-{shard}", _add_shard_entries, get_pool(shard_path(shard)),
+                groups.get(shard, []), rated_groups.get(shard, []))
+        for shard in set(groups) | set(rated_groups))))
+
+
+async def claim_reminders_async(rows):
+    return [row for claimed in await _write_by_shard(_claim_shard_reminders, rows) for row in claimed]
+
+
+async def unclaim_reminders_async(rows):
+    return sum(await _write_by_shard(_unclaim_shard_reminders, rows))
+
+
+get_entries_version_async = _offload("read", get_entries_version)
+has_entries_async = _offload("read", has_entries)
+get_last_export_async = _offload("read", get_last_export)
+set_last_export_async = _offload("write", set_last_export)
+add_user_parameters_async = _offload("write", add_user_parameters)
+remove_user_parameter_async = _offload("write", remove_user_parameter)
+set_user_timezone_async = _offload("write", set_user_timezone)
+set_user_reminders_async = _offload("write", set_user_reminders)
+_load_user_settings_async = _offload("read", get_user_settings)
+
+
+async def get_user_settings_async(user_id):
+    # Cache hits are served on the event loop without a thread hop
+    settings = settings_cache.peek(user_id)
+    if settings is None:
+        settings = await _load_user_settings_async(user_id)
+    return settings
+
+
+async def get_user_parameters_async(user_id):
+    return list((await get_user_settings_async(user_id)).parameters)
+
+
+async def get_user_timezone_async(user_id):
+    return (await get_user_settings_async(user_id)).timezone
+
+
+get_all_users_with_reminders_async = _offload("read", get_all_users_with_reminders)
+filter_unrated_reminders_async = _offload("read", filter_unrated_reminders)
+acquire_reminder_leases_async = _offload("write-0", acquire_reminder_leases)
+release_reminder_leases_async = _offload("write-0", release_reminder_leases)
+get_settings_changes_async = _offload("read", get_settings_changes)
+reload_user_settings_async = _offload("read", reload_user_settings)
+
+
+async def prune_reminder_ledger_async(before_date):
+    before_day = to_day_number(before_date)
+    removed = await asyncio.gather(*(
+        _run_in(f"write-{index}", _prune_shard_ledger, get_pool(shard_path(index)), before_day)
+        for index in range(SHARD_COUNT)))
+    return sum(removed)
+
+
+async def prune_settings_changes_async(before):
+    removed = await asyncio.gather(*(
+        _run_in(f"write-{index}", _prune_shard_settings_changes, get_pool(shard_path(index)), before)
+        for index in range(SHARD_COUNT)))
+    return sum(removed)
+
+# =======================
+# Write-behind buffer
+# =======================
+# At peak many chats finish an estimate within the same few seconds. Instead
+# of one commit per chat, inserts are collected here and written in a single
+# group commit every `flush_interval` seconds or as soon as `max_rows` rows are
+# pending. submit() only returns once the rows are committed and fsynced
+# (see _synchronous_full), so the caller can confirm to the user afterwards.
+class WriteBehindBuffer:
+    def __init__(self, flush_interval=0.05, max_rows=500):
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.flushes = 0
+        self.rows_flushed = 0
+        self._rows = []
+        self._rated = {}                # user_id -> latest local date rated
+        self._waiters = []
+        self._timer = None
+        self._tasks = set()
+        self._closed = False
+
+    @property
+    def pending(self):
+        return len(self._rows)
+
+    async def submit(self, rows, rated=None):
+        # rated: optional (user_id, local_date) recorded in the same commit
+        if self._closed:
+            raise RuntimeError("write buffer is closed")
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._rows.extend(rows)
+        if rated is not None:
+            user_id, local_date = rated
+            self._rated[user_id] = max(local_date, self._rated.get(user_id, local_date))
+        self._waiters.append(waiter)
+        if len(self._rows) >= self.max_rows:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._start_flush)
+        await waiter
+
+    def _start_flush(self):
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        rows, self._rows = self._rows, []
+        rated, self._rated = list(self._rated.items()), {}
+        waiters, self._waiters = self._waiters, []
+        if not rows and not rated:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            return
+        try:
+            await add_entries_async(rows, rated)
+        except Exception as e:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            return
+        self.flushes += 1
+        self.rows_flushed += len(rows)
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def close(self):
+        self._closed = True
+        await self.flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)